@@ -1,141 +1,470 @@
 """
 Python Script for analyzing CitiBike dataset and NYPD's publicly available dataset on traffic accidents for finding
 opportunities for cooperation on Insurance.
+
+The analysis is organized in stages, each writing its results to disk:
+    accidents            cleaned and geocoded bike accidents with their accident outcome
+    accidents_by_borough cyclist injuries and deaths by borough
+    rentals              CitiBike rentals by borough and zipcode
+    report               bike accidents and CitiBike rentals by borough
+    plot                 bar-diagram of the report
+    station_exposure     bike accidents near every CitiBike station per 100k rides starting there
+    timeseries           hourly or daily rentals and bike accidents by borough with rolling rates
+    rate_index           precomputed accidents, injuries, deaths and rentals per zipcode and borough for rate queries
+Stages whose inputs did not change since the last run are skipped.
+
+The script runs headless: pandas, numpy and matplotlib are only imported by the stages using them, and the
+bar-diagram is written with the non-interactive Agg backend unless --show is given.
 """
 import os
-import glob
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 import warnings
 warnings.filterwarnings("ignore")
 
 from preprocessing.dataCleaning import clean_data
 from preprocessing.mapVehicles import correct_vehicle_names
-from preprocessing.determine_zipcode_borough_for_CitiBike import get_zipcode_borough_info
+from preprocessing.citibikeIngest import update_rental_rollups, find_citibike_files, select_citibike_files
 from preprocessing.determine_zipcode_borough_for_NYPDbikeAccidents import get_zipcode_borough_using_NYmapinfo
-
-# Filepaths for Bike Accidents dataset and CitiBike dataset
-# Note: NYPD publicly available dataset "Motor Vehicle Collisions - Crashes" is processed using the python script
-# create_BikeAccidentData.py for selecting only the accidents that involved bikes and result is stored in a csv file.
-# Note: CitiBike data for January 2023 is considered due to hardware limitation as each month contains around 2 Million
-# rows. However, the code can handle more files on suitable hardware.
-nyBikeAccidents_filepath = "bikeAccidentsNY.csv"
-citibike_filepath = "citibike-tripdata"
-
-print("\nStarted Processing NY Bike Accidents dataset.")
-# Reading in NY Bike Accidents data into a Pandas Dataframe
-bikeAccidents = pd.read_csv(nyBikeAccidents_filepath)
-print("\nShape of Bike Accident data: {:}".format(bikeAccidents.shape))
-print("\nPrinting the Columns in the Bike Accidents dataset: ")
-print(bikeAccidents.columns)
-
-# Some entries bikeAccidents Dataframe are missing location information. This information is filled in with the
-# help of the function get_zipcode_borough_bikeAccidents from the preprocessing script zipcode_borough_determination.py
-print("\nNumber of entries missing (Latitude, Longitude) for accidents: {:}".format(bikeAccidents["latitude"].isna().sum()))
-
-# Filling in the missing Location information
-bikeAccidents = get_zipcode_borough_using_NYmapinfo(bikeAccidents)
-
-# Correct the names in the VEHICLE TYPE CODE columns
-bikeAccidents = correct_vehicle_names(bikeAccidents)
-
-# Clean the bikeAccidents Dataframe with the help of the function clean_data from the preprocessing script
-# dataCleaning.py
-bikeAccidents = clean_data(bikeAccidents)
-
-# We now encode bike accidents in terms of the seriousness of Injury in the variable accident_outcome
-# accident_outcome: 0 = unharmed, 1 = injured, 2 = death
-# Append new column and initialize with NaNs
-bikeAccidents["accident_outcome"] = np.nan
-# unharmed
-mask = (bikeAccidents["number of cyclist injured"] == 0)
-bikeAccidents.loc[mask, "accident_outcome"] = 0
-# injured
-mask = bikeAccidents["number of cyclist injured"] > 0
-bikeAccidents.loc[mask, "accident_outcome"] = 1
-# deaths
-mask = bikeAccidents["number of cyclist killed"] > 0
-bikeAccidents.loc[mask, "accident_outcome"] = 2
-
-print("\nPrinting the Column-names in the DataFrames: ")
-print(bikeAccidents.columns)
-
-print("\nPrinting the Time Interval for all Bike Accidents: ")
-print(bikeAccidents["datetime"].min())
-print(bikeAccidents["datetime"].max())
-
-print("\nBreakdown Bike Accidents by Number of Cyclists UnHarmed, Injured and Deaths:")
-print(bikeAccidents["accident_outcome"].value_counts().sort_index())
-
-# Generating breakdown of accidents by District (Borough)
-bikeAccidents_borough = bikeAccidents.groupby(["borough"])[["number of cyclist killed", "number of cyclist injured"]].sum().sort_index()
+from preprocessing.geocoding import NY_ZIPCODE_FILEPATH
+from preprocessing.frameCache import frame_path, write_frame, read_frame, read_frames
+from preprocessing.schema import ACCIDENT_READ_DTYPES, ACCIDENT_DTYPES, compact_bike_accidents
+from preprocessing.instrumentation import StageProfiler
+from preprocessing.pipeline import Stage, run_pipeline
+from preprocessing.stationExposure import load_station_trips, station_exposure
+from preprocessing.rollups import rollup_accidents, rollup_accidents_hourly, write_rollups, query_rollups
+from preprocessing.timeSeries import query_exposure_series
+from preprocessing.rateIndex import build_rate_index, load_rate_index
 
 # Get population of the different districts (boroughs) in NY from https://www.citypopulation.de/en/usa/newyorkcity/
-# Compute cyclist injuries and deaths per 100k in these districts.
 # BRONX: 1356476, BROOKLYN: 2561225, MANHATTAN: 1597451, QUEENS: 2252196, STATEN ISLAND: 490687
-bikeAccidents_borough["Population"] = [1356476, 2561225, 1597451, 2252196, 490687]
-bikeAccidents_borough["injuries_per_100k"] = 1e5*bikeAccidents_borough["number of cyclist injured"] / bikeAccidents_borough["Population"]
-bikeAccidents_borough["deaths_per_100k"] = 1e5*bikeAccidents_borough["number of cyclist killed"] / bikeAccidents_borough["Population"]
-bikeAccidents_borough.round(decimals={"Population": -3, "injuries_per_100k": 0, "deaths_per_100k": 2})
-
-print("\nCompleted Processing of NY Bike Accidents Dataset.")
-
-print("\nStarted Processing CitiBike Dataset.")
-# Our goal is to find the breakdown of Bikes rented by the Boroughs in which the bke accidents occurred.
-# For this we use the starting (latitude, longitude) information to determine in which districts the bikes were rented.
-files = sorted(glob.glob(os.path.join(citibike_filepath, '*.csv')))
-print("\nThe CitiBike files being processed are:  {:}".format(files))
-citibikeData = pd.DataFrame()
-for i, file in enumerate(files):
-    df = pd.read_csv(file)
-    citibikeData = pd.concat([citibikeData, df])
-
-print("\nShape of Citibike Data: {:}".format(citibikeData.shape))
-print("\nThe Columns of CitiBike Data are: ")
-print(citibikeData.columns)
-
-# Augment CitiBike Data with borough and zipcode information from which the bikes were rented
-# using starting station latitude (start_lat) and starting station longitude (start_lng) from the CitiBike Dataset
-# For this step we use the Borough and Zipcode information of New York (NY-zip-code-latitude-and-longitude.csv)
-citibikeData_Borough_Zipcode = get_zipcode_borough_info(citibikeData)
-
-print("\nBreakdown of Bikes Rented by Districts (Boroughs): ")
-citibikeRented_borough = citibikeData_Borough_Zipcode["borough"].value_counts().sort_index()
-print(citibikeRented_borough)
-bikeRentalCounts = citibikeRented_borough.tolist()
-
-print("\nCompleted Processing CitiBike Dataset.")
-
-# Concatenating Citibike rentals by borough with accident information
-bikeAccidents_borough.insert(2, "CitiBikesRented", [bikeRentalCounts[0], bikeRentalCounts[1], bikeRentalCounts[2], bikeRentalCounts[3], 0])
-bikeAccidents_borough["CitiBikesRented_per_100k"] = 1e5*bikeAccidents_borough["CitiBikesRented"] / bikeAccidents_borough["Population"]
-bikeAccidents_borough.round(decimals={"CitiBikesRented_per_100k": 2})
-print("\nBreakdown of Bike Accidents and CitiBike Rentals by Borough")
-print(bikeAccidents_borough)
-
-barWidth = 0.25
-fig = plt.subplots(figsize=(12, 8))
-#num_killed = 1e2*bikeAccidents_borough["number of cyclist killed"]
-num_killed = 1e2*bikeAccidents_borough["deaths_per_100k"]
-num_killed = num_killed.tolist()
-#num_injured = bikeAccidents_borough["number of cyclist injured"].tolist()
-num_injured = bikeAccidents_borough["injuries_per_100k"].tolist()
-num_rentedbikes = bikeAccidents_borough["CitiBikesRented_per_100k"].tolist()
-
-br1 = np.arange(len(num_killed))
-br2 = [x + barWidth for x in br1]
-br3 = [x + barWidth for x in br2]
-
-plt.bar(br1, num_killed, color='r', width=barWidth, edgecolor='grey', label='Deaths per 100k of the population times 100')
-plt.bar(br2, num_injured, color='g', width=barWidth, edgecolor='grey', label='Injuries per 100k of the population')
-plt.bar(br3, num_rentedbikes, color='b', width=barWidth, edgecolor='grey', label='Bikes Rented per 100k of the population')
-plt.title('Visualization of cyclists killed (per 10Mil), injured (per 100k) and CitiBikes rented (per 100k)')
-plt.xlabel('Borough', fontweight='bold', fontsize=15)
-plt.ylabel('Frequency', fontweight='bold', fontsize=15)
-plt.xticks([r + barWidth for r in range(len(num_killed))], ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island"])
-plt.legend()
-plt.savefig('Bar-diagram visualization')
-plt.show()
-print("\nSaved Bar-diagram.")
+borough_population = {"Bronx": 1356476, "Brooklyn": 2561225, "Manhattan": 1597451, "Queens": 2252196,
+                      "Staten island": 490687}
+
+# Columns of the cleaned Bike Accidents dataset used in the analysis.
+bikeAccidents_columns = ["datetime", "borough", "zip code", "number of cyclist injured", "number of cyclist killed",
+                         "accident_outcome"]
+
+
+def parse_arguments(argv=None):
+    # Filepaths for Bike Accidents dataset and CitiBike dataset
+    # Note: NYPD publicly available dataset "Motor Vehicle Collisions - Crashes" is processed using the python script
+    # create_BikeAccidentData.py for selecting only the accidents that involved bikes and result is stored in a csv
+    # file.
+    # Note: CitiBike data for January 2023 is considered for reproducing the results. As the trip files are streamed
+    # in chunks, more months can be processed without needing more memory.
+    my_parser = argparse.ArgumentParser(description="Analyzing CitiBike rentals and NYPD bike accidents by borough")
+
+    my_parser.add_argument("--accidents", type=str, default="bikeAccidentsNY.csv",
+                           help="Bike accidents csv file created by create_BikeAccidentData.py, or the folder of "
+                                "partition files created by it with --output-dir")
+    my_parser.add_argument("--citibike", type=str, default="citibike-tripdata",
+                           help="Folder with the CitiBike trip files (.csv or .zip)")
+    my_parser.add_argument("--months", type=str, nargs=2, metavar=("FIRST", "LAST"),
+                           help="Only use the CitiBike trips of the months FIRST to LAST (YYYY-MM)")
+    my_parser.add_argument("--stage", type=str, nargs="+", dest="stages",
+                           help="Run only these stages (and the stages they need that are not up to date)")
+    my_parser.add_argument("--force", action="store_true", help="Run the stages even if they are up to date")
+    my_parser.add_argument("--cache-dir", type=str, default="cache",
+                           help="Folder for the intermediate results of the stages")
+    my_parser.add_argument("--output-dir", type=str, default=".", help="Folder for the report and the bar-diagram")
+    my_parser.add_argument("--boundaries", type=str,
+                           help="GeoJSON file of zipcode and/or borough areas, for assigning zipcodes and boroughs by "
+                                "the area containing a location instead of by the nearest zipcode")
+    my_parser.add_argument("--stations", type=str,
+                           help="Zipcode and borough of every CitiBike station already geocoded in previous runs "
+                                "(default: citibike-station-zipcodes.csv, or citibike-station-boundaries.csv "
+                                "with --boundaries, in the cache folder)")
+    my_parser.add_argument("--chunksize", type=int, default=500000, help="Number of CitiBike trips read at once")
+    my_parser.add_argument("--workers", type=int, default=1,
+                           help="Number of worker processes for processing the CitiBike trip files in parallel")
+    my_parser.add_argument("--radius", type=float, default=250,
+                           help="Accidents within this distance (meters) of a CitiBike station count as near it")
+    my_parser.add_argument("--window", type=float, default=60,
+                           help="Trips within this many minutes of a crash count as active around it")
+    my_parser.add_argument("--freq", type=str, choices=["hour", "day"], default="day",
+                           help="Time buckets of the rentals and bike accidents time series")
+    my_parser.add_argument("--rolling", type=int, default=7,
+                           help="Number of time buckets the rolling rates of the time series are computed over")
+    my_parser.add_argument("--profile", type=str,
+                           help="Record time, rows and peak memory of every stage and write them to this json file")
+    my_parser.add_argument("--show", action="store_true", help="Show the bar-diagram in a window after the run")
+
+    args = my_parser.parse_args(argv)
+
+    # Stations geocoded by the nearest zipcode and by the boundaries are cached separately.
+    if args.stations is None:
+        stations = "citibike-station-zipcodes.csv" if args.boundaries is None else "citibike-station-boundaries.csv"
+        args.stations = os.path.join(args.cache_dir, stations)
+
+    return args
+
+
+def prepare_bike_accidents(args, profiler):
+    import pandas as pd
+
+    print("\nStarted Processing NY Bike Accidents dataset.")
+    # Reading in NY Bike Accidents data into a Pandas Dataframe
+    # Columns are read with the compact types from the preprocessing script schema.py.
+    with profiler.stage("load") as record:
+        bikeAccidents = read_bike_accidents(accident_files(args))
+        record["rows_out"] = bikeAccidents.shape[0]
+    print("\nShape of Bike Accident data: {:}".format(bikeAccidents.shape))
+    print("\nPrinting the Columns in the Bike Accidents dataset: ")
+    print(bikeAccidents.columns)
+
+    # Some entries bikeAccidents Dataframe are missing location information. This information is filled in with the
+    # help of the function get_zipcode_borough_bikeAccidents from the preprocessing script zipcode_borough_determination.py
+    print("\nNumber of entries missing (Latitude, Longitude) for accidents: {:}".format(bikeAccidents["latitude"].isna().sum()))
+
+    # Filling in the missing Location information
+    with profiler.stage("geocode", rows_in=bikeAccidents.shape[0]) as record:
+        bikeAccidents = get_zipcode_borough_using_NYmapinfo(bikeAccidents, boundaries=args.boundaries)
+        record["rows_out"] = bikeAccidents.shape[0]
+
+    # Correct the names in the VEHICLE TYPE CODE columns
+    with profiler.stage("vehicle_names", rows_in=bikeAccidents.shape[0]) as record:
+        bikeAccidents = correct_vehicle_names(bikeAccidents)
+        record["rows_out"] = bikeAccidents.shape[0]
+
+    # Clean the bikeAccidents Dataframe with the help of the function clean_data from the preprocessing script
+    # dataCleaning.py
+    with profiler.stage("clean", rows_in=bikeAccidents.shape[0]) as record:
+        bikeAccidents = clean_data(bikeAccidents)
+        bikeAccidents = compact_bike_accidents(bikeAccidents)
+        record["rows_out"] = bikeAccidents.shape[0]
+
+    # We now encode bike accidents in terms of the seriousness of Injury in the variable accident_outcome
+    # accident_outcome: 0 = unharmed, 1 = injured, 2 = death
+    with profiler.stage("outcome_encoding", rows_in=bikeAccidents.shape[0]):
+        # Append new column as small integers and initialize with missing values
+        bikeAccidents["accident_outcome"] = pd.Series(pd.NA, index=bikeAccidents.index,
+                                                      dtype=ACCIDENT_DTYPES["accident_outcome"])
+        # unharmed
+        mask = (bikeAccidents["number of cyclist injured"] == 0).fillna(False)
+        bikeAccidents.loc[mask, "accident_outcome"] = 0
+        # injured
+        mask = (bikeAccidents["number of cyclist injured"] > 0).fillna(False)
+        bikeAccidents.loc[mask, "accident_outcome"] = 1
+        # deaths
+        mask = (bikeAccidents["number of cyclist killed"] > 0).fillna(False)
+        bikeAccidents.loc[mask, "accident_outcome"] = 2
+
+    print("\nPrinting the Column-names in the DataFrames: ")
+    print(bikeAccidents.columns)
+
+    print("\nPrinting the Time Interval for all Bike Accidents: ")
+    print(bikeAccidents["datetime"].min())
+    print(bikeAccidents["datetime"].max())
+
+    print("\nBreakdown Bike Accidents by Number of Cyclists UnHarmed, Injured and Deaths:")
+    print(bikeAccidents["accident_outcome"].value_counts().sort_index())
+
+    write_frame(bikeAccidents, paths(args)["accidents"])
+
+
+def aggregate_bike_accidents_by_borough(args, profiler):
+    bikeAccidents = read_frame(paths(args)["accidents"], columns=bikeAccidents_columns)
+
+    # Generating breakdown of accidents by District (Borough)
+    # The accidents are reduced to monthly rollups (see the preprocessing script rollups.py), which are then summed.
+    with profiler.stage("borough_aggregation", rows_in=bikeAccidents.shape[0]) as record:
+        write_rollups(rollup_accidents(bikeAccidents), paths(args)["rollups"], "accidents", "bikeAccidents")
+        bikeAccidents_borough = query_rollups(paths(args)["rollups"], "accidents", ["borough"])
+        bikeAccidents_borough = bikeAccidents_borough.rename(columns={"cyclists_killed": "number of cyclist killed",
+                                                                      "cyclists_injured": "number of cyclist injured"})
+        bikeAccidents_borough = bikeAccidents_borough[["number of cyclist killed", "number of cyclist injured"]]
+        record["rows_out"] = bikeAccidents_borough.shape[0]
+
+    # Compute cyclist injuries and deaths per 100k in these districts.
+    bikeAccidents_borough["Population"] = bikeAccidents_borough.index.astype(str).map(borough_population)
+    bikeAccidents_borough["injuries_per_100k"] = 1e5*bikeAccidents_borough["number of cyclist injured"] / bikeAccidents_borough["Population"]
+    bikeAccidents_borough["deaths_per_100k"] = 1e5*bikeAccidents_borough["number of cyclist killed"] / bikeAccidents_borough["Population"]
+
+    print("\nCompleted Processing of NY Bike Accidents Dataset.")
+
+    bikeAccidents_borough.to_csv(paths(args)["accidents_by_borough"])
+
+
+def count_citibike_rentals(args, profiler):
+    print("\nStarted Processing CitiBike Dataset.")
+    # Our goal is to find the breakdown of Bikes rented by the Boroughs in which the bke accidents occurred.
+    # For this we use the starting (latitude, longitude) information to determine in which districts the bikes were
+    # rented. The trip files are streamed in chunks of args.chunksize rows, so memory stays flat for any number of
+    # months. Monthly .zip archives are read directly, without unpacking them.
+    files = citibike_files(args)
+    print("\nThe CitiBike files being processed are:  {:}".format(files))
+
+    # Augment CitiBike Data with borough and zipcode information from which the bikes were rented
+    # using starting station latitude (start_lat) and starting station longitude (start_lng) from the CitiBike Dataset
+    # For this step we use the Borough and Zipcode information of New York (NY-zip-code-latitude-and-longitude.csv)
+    # Every starting station is geocoded only once and cached in args.stations for later runs.
+    # Every trip file is reduced to monthly rollups (see the preprocessing script rollups.py) that are kept until the
+    # file changes, the rentals by borough and zipcode are then summed from the rollups of the selected files over the
+    # selected months, as yearly archives also hold the trips of other months.
+    with profiler.stage("citibike_ingest") as record:
+        update_rental_rollups(files, paths(args)["rollups"], chunksize=args.chunksize, cache_file=args.stations,
+                              workers=args.workers, boundaries=args.boundaries)
+
+    with profiler.stage("rental_rollups") as record:
+        sources = [os.path.basename(file) for file in files]
+        citibikeRented_borough = query_rollups(paths(args)["rollups"], "rentals", ["borough"], months=args.months,
+                                               sources=sources)["rentals"]
+        citibikeRented_zipcode = query_rollups(paths(args)["rollups"], "rentals", ["zipcode"], months=args.months,
+                                               sources=sources)["rentals"]
+        num_trips = citibikeRented_borough.sum()
+        record["rows_in"] = num_trips
+        record["rows_out"] = citibikeRented_borough.shape[0]
+    print("\nNumber of CitiBike trips processed: {:}".format(num_trips))
+
+    print("\nBreakdown of Bikes Rented by Districts (Boroughs): ")
+    print(citibikeRented_borough)
+
+    print("\nCompleted Processing CitiBike Dataset.")
+
+    citibikeRented_borough.rename_axis("borough").rename("CitiBikesRented").to_csv(paths(args)["rentals_by_borough"])
+    citibikeRented_zipcode.rename_axis("zipcode").rename("CitiBikesRented").to_csv(paths(args)["rentals_by_zipcode"])
+
+
+def report_accidents_and_rentals(args, profiler):
+    import pandas as pd
+
+    bikeAccidents_borough = pd.read_csv(paths(args)["accidents_by_borough"], index_col="borough")
+    citibikeRented_borough = pd.read_csv(paths(args)["rentals_by_borough"], index_col="borough")["CitiBikesRented"]
+
+    # Align the rentals with the boroughs of the accidents, boroughs without CitiBike stations have no rentals.
+    bikeRentalCounts = citibikeRented_borough.reindex(bikeAccidents_borough.index.str.upper(), fill_value=0).tolist()
+
+    # Concatenating Citibike rentals by borough with accident information
+    bikeAccidents_borough.insert(2, "CitiBikesRented", bikeRentalCounts)
+    bikeAccidents_borough["CitiBikesRented_per_100k"] = 1e5*bikeAccidents_borough["CitiBikesRented"] / bikeAccidents_borough["Population"]
+    print("\nBreakdown of Bike Accidents and CitiBike Rentals by Borough")
+    print(bikeAccidents_borough)
+
+    bikeAccidents_borough.to_csv(paths(args)["report"])
+
+
+def plot_accidents_and_rentals(args, profiler):
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+
+    # Charts are only written to disk, unless they are shown at the end of the run.
+    if not args.show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    bikeAccidents_borough = pd.read_csv(paths(args)["report"], index_col="borough")
+
+    barWidth = 0.25
+    fig = plt.subplots(figsize=(12, 8))
+    #num_killed = 1e2*bikeAccidents_borough["number of cyclist killed"]
+    num_killed = 1e2*bikeAccidents_borough["deaths_per_100k"]
+    num_killed = num_killed.tolist()
+    #num_injured = bikeAccidents_borough["number of cyclist injured"].tolist()
+    num_injured = bikeAccidents_borough["injuries_per_100k"].tolist()
+    num_rentedbikes = bikeAccidents_borough["CitiBikesRented_per_100k"].tolist()
+
+    br1 = np.arange(len(num_killed))
+    br2 = [x + barWidth for x in br1]
+    br3 = [x + barWidth for x in br2]
+
+    plt.bar(br1, num_killed, color='r', width=barWidth, edgecolor='grey', label='Deaths per 100k of the population times 100')
+    plt.bar(br2, num_injured, color='g', width=barWidth, edgecolor='grey', label='Injuries per 100k of the population')
+    plt.bar(br3, num_rentedbikes, color='b', width=barWidth, edgecolor='grey', label='Bikes Rented per 100k of the population')
+    plt.title('Visualization of cyclists killed (per 10Mil), injured (per 100k) and CitiBikes rented (per 100k)')
+    plt.xlabel('Borough', fontweight='bold', fontsize=15)
+    plt.ylabel('Frequency', fontweight='bold', fontsize=15)
+    plt.xticks([r + barWidth for r in range(len(num_killed))], ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island"])
+    plt.legend()
+    plt.savefig(paths(args)["plot"])
+    if not args.show:
+        plt.close("all")
+    print("\nSaved Bar-diagram.")
+
+
+def join_accidents_to_stations(args, profiler):
+    print("\nStarted joining Bike Accidents to CitiBike stations and trips.")
+    bikeAccidents = read_frame(paths(args)["accidents"],
+                               columns=["datetime", "collision id", "borough", "latitude", "longitude"])
+
+    # Start and end times and starting stations of all CitiBike trips.
+    with profiler.stage("station_trips") as record:
+        stations, trips = load_station_trips(citibike_files(args), chunksize=args.chunksize, months=args.months)
+        record["rows_out"] = trips["start"].shape[0]
+
+    # Join every accident in the period of the trips to the stations within args.radius meters and to the trips
+    # within args.window minutes of the crash.
+    with profiler.stage("spatiotemporal_join", rows_in=bikeAccidents.shape[0]) as record:
+        accidentExposure, stationExposure = station_exposure(bikeAccidents, stations, trips, radius=args.radius,
+                                                             window=60*args.window)
+        record["rows_out"] = accidentExposure.shape[0]
+
+    print("\nNumber of Bike Accidents during the CitiBike trips: {:}".format(accidentExposure.shape[0]))
+    print("Number of them within {:} meters of a CitiBike station: {:}".format(
+        args.radius, (accidentExposure["nearby_stations"] > 0).sum()))
+
+    print("\nCitiBike stations with the most Bike Accidents nearby: ")
+    print(stationExposure.sort_values(["accidents", "rides"], ascending=False).head(10).to_string(index=False))
+
+    write_frame(accidentExposure, paths(args)["accident_exposure"])
+    stationExposure.to_csv(paths(args)["station_exposure"], index=False)
+
+
+def build_exposure_timeseries(args, profiler):
+    print("\nStarted building the time series of CitiBike rentals and Bike Accidents.")
+    bikeAccidents = read_frame(paths(args)["accidents"], columns=bikeAccidents_columns)
+
+    # The accidents are reduced to hourly rollups like the rentals, which are then bucketed by args.freq and rolled
+    # over args.rolling buckets.
+    with profiler.stage("timeseries", rows_in=bikeAccidents.shape[0]) as record:
+        write_rollups(rollup_accidents_hourly(bikeAccidents), paths(args)["rollups"], "accidents_hourly",
+                      "bikeAccidents")
+        sources = [os.path.basename(file) for file in citibike_files(args)]
+        exposureSeries = query_exposure_series(paths(args)["rollups"], freq=args.freq, window=args.rolling,
+                                               months=args.months, sources=sources)
+        record["rows_out"] = exposureSeries.shape[0]
+
+    print("\nCitiBike rentals and Bike Accidents per {:} by borough over {:} buckets: {:}".format(
+        args.freq, exposureSeries["time"].nunique(), exposureSeries["borough"].unique().tolist()))
+
+    exposureSeries.to_csv(paths(args)["timeseries"], index=False)
+
+
+def build_rates_index(args, profiler):
+    # The accident and rental rollups are turned into running sums per zipcode and borough, from which rates over any
+    # range of months are answered without reading the rollups again (see the preprocessing script rateIndex.py).
+    with profiler.stage("rate_index") as record:
+        sources = [os.path.basename(file) for file in citibike_files(args)]
+        build_rate_index(paths(args)["rollups"], paths(args)["rate_index"], sources=sources, months=args.months,
+                         population=borough_population)
+        rateIndex = load_rate_index(paths(args)["rate_index"])
+        record["rows_out"] = rateIndex.tables["zipcode"]["keys"].shape[0]
+
+    print("\nRate index of {:} zipcodes written to {:}.".format(rateIndex.tables["zipcode"]["keys"].shape[0],
+                                                             paths(args)["rate_index"]))
+    if rateIndex.info["rate_months"] is not None:
+        print("Bike Accidents and CitiBike rentals of NYC over the months {:} to {:} covered by both: ".format(
+            *rateIndex.info["rate_months"]))
+    else:
+        print("Bike Accidents and CitiBike rentals of NYC, which cover no common months: ")
+    print(rateIndex.query())
+
+
+def paths(args):
+    """
+    Files written by the stages.
+    """
+    return {
+        "accidents": frame_path(os.path.join(args.cache_dir, "bikeAccidents")),
+        "rollups": os.path.join(args.cache_dir, "rollups"),
+        "accidents_by_borough": os.path.join(args.cache_dir, "bikeAccidents_borough.csv"),
+        "rentals_by_borough": os.path.join(args.cache_dir, "citibikeRentals_borough.csv"),
+        "rentals_by_zipcode": os.path.join(args.cache_dir, "citibikeRentals_zipcode.csv"),
+        "report": os.path.join(args.output_dir, "bikeAccidents_citibikeRentals_borough.csv"),
+        "plot": os.path.join(args.output_dir, "Bar-diagram visualization.png"),
+        "accident_exposure": frame_path(os.path.join(args.cache_dir, "bikeAccidents_exposure")),
+        "station_exposure": os.path.join(args.output_dir, "citibikeStations_exposure.csv"),
+        "timeseries": os.path.join(args.output_dir, "bikeAccidents_citibikeRentals_timeseries.csv"),
+        "rate_index": os.path.join(args.output_dir, "rate-index"),
+    }
+
+
+def accident_files(args):
+    """
+    Bike accident csv file, or the partition files if a folder of partitions is given.
+    """
+    import glob
+
+    if os.path.isdir(args.accidents):
+        return sorted(glob.glob(os.path.join(args.accidents, "*.parquet")) +
+                      glob.glob(os.path.join(args.accidents, "*.pkl")))
+    return [args.accidents]
+
+
+def read_bike_accidents(files):
+    """
+    Read the bike accidents from a csv file or from partition files. Text columns of the partitions are converted to
+    plain objects with NaN for missing values, as read from a csv file.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if len(files) == 1 and files[0].endswith(".csv"):
+        return pd.read_csv(files[0], dtype=ACCIDENT_READ_DTYPES)
+
+    bikeAccidents = read_frames(files)
+    for col in bikeAccidents.columns:
+        if isinstance(bikeAccidents[col].dtype, pd.StringDtype):
+            bikeAccidents[col] = bikeAccidents[col].to_numpy(dtype=object, na_value=np.nan)
+    dtypes = {col: dtype for col, dtype in ACCIDENT_READ_DTYPES.items() if col in bikeAccidents.columns}
+    return bikeAccidents.astype(dtypes)
+
+
+def citibike_files(args):
+    """
+    CitiBike trip files of the selected months.
+    """
+    return select_citibike_files(find_citibike_files(args.citibike), args.months)
+
+
+def build_stages(args, profiler):
+    """
+    Declare the stages of the analysis with their inputs and outputs.
+    """
+    files = paths(args)
+    geocoding_inputs = [NY_ZIPCODE_FILEPATH] + ([args.boundaries] if args.boundaries is not None else [])
+
+    return [
+        Stage("accidents", lambda: prepare_bike_accidents(args, profiler),
+              inputs=accident_files(args) + geocoding_inputs, outputs=[files["accidents"]]),
+        Stage("accidents_by_borough", lambda: aggregate_bike_accidents_by_borough(args, profiler),
+              depends=["accidents"], outputs=[files["accidents_by_borough"]],
+              params={"population": borough_population}),
+        Stage("rentals", lambda: count_citibike_rentals(args, profiler),
+              inputs=citibike_files(args) + geocoding_inputs,
+              outputs=[files["rentals_by_borough"], files["rentals_by_zipcode"]],
+              params={"months": args.months}),
+        Stage("report", lambda: report_accidents_and_rentals(args, profiler),
+              depends=["accidents_by_borough", "rentals"], outputs=[files["report"]]),
+        Stage("plot", lambda: plot_accidents_and_rentals(args, profiler),
+              depends=["report"], outputs=[files["plot"]]),
+        Stage("station_exposure", lambda: join_accidents_to_stations(args, profiler),
+              inputs=citibike_files(args), depends=["accidents"],
+              outputs=[files["accident_exposure"], files["station_exposure"]],
+              params={"radius": args.radius, "window": args.window, "months": args.months}),
+        Stage("timeseries", lambda: build_exposure_timeseries(args, profiler),
+              depends=["accidents", "rentals"], outputs=[files["timeseries"]],
+              params={"freq": args.freq, "rolling": args.rolling}),
+        Stage("rate_index", lambda: build_rates_index(args, profiler),
+              depends=["accidents_by_borough", "rentals"],
+              outputs=[os.path.join(files["rate_index"], "index.json")],
+              params={"population": borough_population}),
+    ]
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    # Per-stage instrumentation, only recording when --profile is given.
+    profiler = StageProfiler(enabled=args.profile is not None)
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    run_pipeline(build_stages(args, profiler), targets=args.stages,
+                 manifest_file=os.path.join(args.cache_dir, "pipeline-manifest.json"), force=args.force,
+                 profiler=profiler, code_files=[os.path.abspath(__file__)])
+
+    if args.profile is not None:
+        print("\nTime spent in the stages of the analysis:")
+        print(profiler.summary())
+        profiler.write(args.profile)
+        print("\nStage profile written to {:}.".format(args.profile))
+
+    if args.show:
+        import matplotlib.pyplot as plt
+        plt.show()
+
 
+if __name__ == "__main__":
+    main()
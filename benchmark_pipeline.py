@@ -0,0 +1,305 @@
+"""
+Python Script for benchmarking the preprocessing and analysis pipeline on synthetic data.
+
+Synthetic bike accident (NYPD-shaped) and CitiBike trip datasets of the requested sizes are generated, every
+preprocessing function is timed and memory-profiled on them, and optionally the full analysis script is run end to
+end. The results are written as json so that runs of different versions can be compared.
+"""
+
+
+def make_bike_accidents(n_rows, output_file, seed=0, chunksize=1000000):
+    """
+    Write a synthetic dataset of n_rows bike accidents with the columns of the NYPD dataset to output_file.
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    vehicles = np.array(["Sedan", "Bike", "BICYCLE", "Station Wagon/Sport Utility Vehicle", "Taxi", "Bus", "E-Bike",
+                         "Box Truck", "Pick-up Truck", "Motorcycle", "UNKNOWN", "Dump", "Ambul", "E-Sco"], dtype=object)
+    boroughs = np.array(["BROOKLYN", "QUEENS", "MANHATTAN", "BRONX", "STATEN ISLAND"], dtype=object)
+    zipcodes = np.array([11201, 11368, 10001, 10451, 10301], dtype=float)
+
+    for start in range(0, n_rows, chunksize):
+        n = min(chunksize, n_rows - start)
+
+        def vehicle_column(p_missing):
+            column = rng.choice(vehicles, n)
+            column[rng.random(n) < p_missing] = np.nan
+            return column
+
+        latitude = rng.uniform(40.5, 40.9, n)
+        longitude = rng.uniform(-74.1, -73.75, n)
+        missing = rng.random(n) < 0.05
+        latitude[missing] = np.nan
+        longitude[missing] = np.nan
+
+        borough_ind = rng.integers(0, boroughs.shape[0], n)
+        borough = boroughs[borough_ind]
+        zipcode = zipcodes[borough_ind]
+        missing = rng.random(n) < 0.3
+        borough[missing] = np.nan
+        zipcode[missing] = np.nan
+
+        persons_injured = rng.integers(0, 3, n).astype(float)
+        if start == 0:
+            # The NYPD dataset has a few accidents with a missing number of persons injured.
+            persons_injured[[min(5, n - 1), min(9, n - 1)]] = np.nan
+
+        crash_date = pd.Timestamp("2013-01-01") + pd.to_timedelta(rng.integers(0, 3650, n), unit="D")
+        crash_time = pd.Series(rng.integers(0, 24, n)).astype(str) + ":" + \
+            pd.Series(rng.integers(0, 60, n)).astype(str).str.zfill(2)
+
+        df = pd.DataFrame({
+            "crash date": crash_date.strftime("%Y-%m-%dT00:00:00.000"),
+            "crash time": crash_time,
+            "borough": borough,
+            "zip code": zipcode,
+            "latitude": latitude,
+            "longitude": longitude,
+            "location": "",
+            "on street name": rng.choice(np.array(["BROADWAY", "5 AVENUE", "ATLANTIC AVENUE", np.nan], dtype=object), n),
+            "off street name": np.nan,
+            "cross street name": rng.choice(np.array(["EAST 10 STREET", np.nan], dtype=object), n),
+            "number of persons injured": persons_injured,
+            "number of persons killed": rng.integers(0, 2, n),
+            "number of pedestrians injured": 0,
+            "number of pedestrians killed": 0,
+            "number of cyclist injured": (rng.random(n) < 0.7).astype(int),
+            "number of cyclist killed": (rng.random(n) < 0.005).astype(int),
+            "number of motorist injured": 0,
+            "number of motorist killed": 0,
+            "contributing factor vehicle 1": rng.choice(["Unspecified", "Illnes", "Driver Inattention/Distraction"], n),
+            "contributing factor vehicle 2": "Unspecified",
+            "contributing factor vehicle 3": np.nan,
+            "contributing factor vehicle 4": np.nan,
+            "contributing factor vehicle 5": np.nan,
+            "collision id": np.arange(start, start + n) + 3000000,
+            "vehicle type code 1": vehicle_column(0.01),
+            "vehicle type code 2": vehicle_column(0.2),
+            "vehicle type code 3": vehicle_column(0.8),
+            "vehicle type code 4": vehicle_column(0.95),
+            "vehicle type code 5": vehicle_column(0.98),
+        })
+        df.to_csv(output_file, index=False, mode="w" if start == 0 else "a", header=start == 0)
+
+
+def make_citibike_trips(n_rows, output_file, seed=0, n_stations=2000, chunksize=1000000):
+    """
+    Write a synthetic dataset of n_rows CitiBike trips with the columns of the CitiBike trip data to output_file.
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    station_lat = rng.uniform(40.6, 40.85, n_stations)
+    station_lng = rng.uniform(-74.05, -73.85, n_stations)
+    station_id = np.array(["{:}.{:02d}".format(1000 + k, k % 100) for k in range(n_stations)], dtype=object)
+
+    for start in range(0, n_rows, chunksize):
+        n = min(chunksize, n_rows - start)
+        start_station = rng.integers(0, n_stations, n)
+        end_station = rng.integers(0, n_stations, n)
+        started_at = pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 31 * 86400, n), unit="s")
+        ended_at = started_at + pd.to_timedelta(rng.integers(60, 3600, n), unit="s")
+
+        df = pd.DataFrame({
+            "ride_id": pd.Series(rng.integers(0, 2**62, n)).map("{:016X}".format),
+            "rideable_type": rng.choice(["classic_bike", "electric_bike"], n),
+            "started_at": started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "ended_at": ended_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "start_station_name": station_id[start_station],
+            "start_station_id": station_id[start_station],
+            "end_station_name": station_id[end_station],
+            "end_station_id": station_id[end_station],
+            "start_lat": station_lat[start_station],
+            "start_lng": station_lng[start_station],
+            "end_lat": station_lat[end_station],
+            "end_lng": station_lng[end_station],
+            "member_casual": rng.choice(["member", "casual"], n),
+        })
+        df.to_csv(output_file, index=False, mode="w" if start == 0 else "a", header=start == 0)
+
+
+def measure(func, *args, memory=False):
+    """
+    Run func(*args) and return its result, the wall time in seconds and, if memory is set, the peak memory
+    allocated during the call in MB as traced by tracemalloc.
+    """
+    import time
+    import tracemalloc
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return result, seconds, peak_mb
+
+
+def benchmark_stage(results, name, n_rows, func, *args, memory=False):
+    """
+    Time func(*args), and in a second run trace its memory, and append the measurement to results.
+    Returns the result of func.
+    """
+    import copy
+
+    result, seconds, _ = measure(func, *copy.deepcopy(args))
+    peak_mb = None
+    if memory:
+        _, _, peak_mb = measure(func, *copy.deepcopy(args), memory=True)
+
+    results.append({"stage": name, "rows": n_rows, "seconds": seconds,
+                    "rows_per_second": n_rows / seconds if seconds > 0 else None, "peak_memory_mb": peak_mb})
+    print("{:<28} {:>10} rows {:>10.3f} s".format(name, n_rows, seconds))
+
+    return result
+
+
+def benchmark_end_to_end(results, n_rows, accidents_file, trips_file, workdir):
+    """
+    Run the analysis script on the synthetic data in a separate process and record its wall time and peak RSS.
+    """
+    import os
+    import sys
+    import json
+    import time
+    import shutil
+    import resource
+    import subprocess
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    rundir = os.path.join(workdir, "end-to-end-{:}".format(n_rows))
+    shutil.rmtree(rundir, ignore_errors=True)
+    os.makedirs(os.path.join(rundir, "citibike-tripdata"))
+
+    shutil.copy(accidents_file, os.path.join(rundir, "bikeAccidentsNY.csv"))
+    os.symlink(os.path.abspath(trips_file), os.path.join(rundir, "citibike-tripdata", os.path.basename(trips_file)))
+    for name in ["analyze_CitiBike_and_NYPDbikeAccidents_data.py", "NY-zip-code-latitude-and-longitude.csv",
+                 "preprocessing"]:
+        os.symlink(os.path.join(repo, name), os.path.join(rundir, name))
+
+    env = dict(os.environ, MPLBACKEND="Agg")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "analyze_CitiBike_and_NYPDbikeAccidents_data.py", "--profile", "profile.json"],
+                   cwd=rundir, env=env, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is the largest RSS of any finished child process, in KB on Linux.
+    peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10
+
+    # The time spent in every stage of the analysis script, as recorded by its --profile option.
+    with open(os.path.join(rundir, "profile.json")) as f:
+        stages = json.load(f)["stages"]
+
+    results.append({"stage": "end_to_end", "rows": n_rows, "seconds": seconds,
+                    "rows_per_second": n_rows / seconds if seconds > 0 else None, "peak_memory_mb": peak_mb,
+                    "stages": stages})
+    print("{:<28} {:>10} rows {:>10.3f} s".format("end_to_end", n_rows, seconds))
+
+
+def run_benchmarks(sizes, workdir, memory=True, end_to_end=True, seed=0):
+    """
+    Run all benchmarks for every size in sizes and return the list of measurements.
+    """
+    import os
+    import shutil
+    import pandas as pd
+
+    from preprocessing.dataCleaning import clean_data
+    from preprocessing.mapVehicles import correct_vehicle_names
+    from preprocessing.rollups import query_rollups
+    from preprocessing.citibikeIngest import update_rental_rollups
+    from preprocessing.determine_zipcode_borough_for_CitiBike import get_zipcode_borough_info
+    from preprocessing.determine_zipcode_borough_for_CitiBike import load_station_cache, assign_station_zipcode_borough
+    from preprocessing.determine_zipcode_borough_for_NYPDbikeAccidents import get_zipcode_borough_using_NYmapinfo
+    from preprocessing.schema import ACCIDENT_READ_DTYPES
+
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+
+    for n_rows in sizes:
+        accidents_file = os.path.join(workdir, "bikeAccidents-{:}-{:}.csv".format(n_rows, seed))
+        trips_file = os.path.join(workdir, "citibike-tripdata-{:}-{:}.csv".format(n_rows, seed))
+        if not os.path.exists(accidents_file):
+            print("Generating {:} synthetic bike accidents.".format(n_rows))
+            make_bike_accidents(n_rows, accidents_file, seed=seed)
+        if not os.path.exists(trips_file):
+            print("Generating {:} synthetic CitiBike trips.".format(n_rows))
+            make_citibike_trips(n_rows, trips_file, seed=seed)
+
+        # Bike accident preprocessing, every stage works on the output of the previous one.
+        df = benchmark_stage(results, "load_bike_accidents", n_rows,
+                             lambda path: pd.read_csv(path, dtype=ACCIDENT_READ_DTYPES), accidents_file, memory=memory)
+        df = benchmark_stage(results, "geocode_bike_accidents", n_rows, get_zipcode_borough_using_NYmapinfo, df,
+                             memory=memory)
+        df = benchmark_stage(results, "correct_vehicle_names", df.shape[0], correct_vehicle_names, df, memory=memory)
+        benchmark_stage(results, "clean_data", df.shape[0], clean_data, df, memory=memory)
+
+        # CitiBike geocoding per trip and per station, the chunked ingestion of the trip file into rollups and a query.
+        trips = pd.read_csv(trips_file, usecols=["start_station_id", "start_lat", "start_lng"],
+                            dtype={"start_station_id": str})
+        benchmark_stage(results, "geocode_trips", n_rows, get_zipcode_borough_info, trips, memory=memory)
+        benchmark_stage(results, "geocode_trips_by_station", n_rows,
+                        lambda df: assign_station_zipcode_borough(df, load_station_cache(None)), trips, memory=memory)
+
+        # The rollups are rebuilt on every call, since update_rental_rollups skips trip files already rolled up.
+        rollup_dir = os.path.join(workdir, "rollups")
+
+        def ingest(path):
+            shutil.rmtree(rollup_dir, ignore_errors=True)
+            return update_rental_rollups([path], rollup_dir, cache_file=None)
+
+        benchmark_stage(results, "ingest_citibike", n_rows, ingest, trips_file, memory=memory)
+        benchmark_stage(results, "query_rollups", n_rows,
+                        lambda path: query_rollups(path, "rentals", ["borough"]), rollup_dir, memory=memory)
+
+        if end_to_end:
+            benchmark_end_to_end(results, n_rows, accidents_file, trips_file, workdir)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    import os
+    import sys
+    import json
+    import platform
+    import argparse
+    import warnings
+
+    my_parser = argparse.ArgumentParser(description="Benchmarking the preprocessing and analysis pipeline")
+
+    my_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                           help="Number of synthetic rows for each benchmark run")
+    my_parser.add_argument("--output", type=str, default="benchmark-results.json", help="Output json filename")
+    my_parser.add_argument("--workdir", type=str, default="benchmark-data",
+                           help="Folder for the synthetic datasets, reused across runs")
+    my_parser.add_argument("--seed", type=int, default=0, help="Seed for generating the synthetic data")
+    my_parser.add_argument("--no-memory", action="store_true", help="Skip the memory profiling runs")
+    my_parser.add_argument("--no-end-to-end", action="store_true", help="Skip running the full analysis script")
+
+    args = my_parser.parse_args()
+
+    # The preprocessing scripts read the NY zipcode file relative to the repository.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    warnings.filterwarnings("ignore")
+
+    import numpy as np
+    import pandas as pd
+
+    benchmark_results = run_benchmarks(args.sizes, args.workdir, memory=not args.no_memory,
+                                       end_to_end=not args.no_end_to_end, seed=args.seed)
+
+    report = {"python": sys.version.split()[0], "pandas": pd.__version__, "numpy": np.__version__,
+              "platform": platform.platform(), "seed": args.seed, "results": benchmark_results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\nBenchmark results written to {:}.".format(args.output))
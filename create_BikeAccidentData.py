@@ -1,4 +1,46 @@
-def collect_bike_accidents_nypd(token=None, query=None, output_file=None):
+# Identifier of the NYPD dataset "Motor Vehicle Collisions - Crashes".
+NYPD_DATASET = "h9gi-nx95"
+
+# SoQL condition selecting all instances involving bike accidents.
+BIKE_ACCIDENT_CONDITION = """
+                VEHICLE_TYPE_CODE1 = 'Bike' OR VEHICLE_TYPE_CODE1 = 'BICYCLE'
+                OR
+                VEHICLE_TYPE_CODE2 = 'Bike' OR VEHICLE_TYPE_CODE2 = 'BICYCLE'
+                OR
+                VEHICLE_TYPE_CODE_3 = 'Bike' OR VEHICLE_TYPE_CODE_3 = 'BICYCLE'
+                OR
+                VEHICLE_TYPE_CODE_4 = 'Bike' OR VEHICLE_TYPE_CODE_4 = 'BICYCLE'
+                OR
+                VEHICLE_TYPE_CODE_5 = 'Bike' OR VEHICLE_TYPE_CODE_5 = 'BICYCLE'
+                OR
+                NUMBER_OF_CYCLIST_INJURED > 0 OR NUMBER_OF_CYCLIST_KILLED > 0
+                """
+
+# Columns of the NYPD dataset. Socrata leaves out missing values, so every page is aligned to these columns.
+NYPD_COLUMNS = ["crash_date", "crash_time", "borough", "zip_code", "latitude", "longitude", "location",
+                "on_street_name", "off_street_name", "cross_street_name",
+                "number_of_persons_injured", "number_of_persons_killed",
+                "number_of_pedestrians_injured", "number_of_pedestrians_killed",
+                "number_of_cyclist_injured", "number_of_cyclist_killed",
+                "number_of_motorist_injured", "number_of_motorist_killed",
+                "contributing_factor_vehicle_1", "contributing_factor_vehicle_2", "contributing_factor_vehicle_3",
+                "contributing_factor_vehicle_4", "contributing_factor_vehicle_5", "collision_id",
+                "vehicle_type_code1", "vehicle_type_code2", "vehicle_type_code_3", "vehicle_type_code_4",
+                "vehicle_type_code_5"]
+
+# Numeric columns of the NYPD dataset, Socrata returns all values as strings.
+NYPD_NUMERIC_COLUMNS = ["zip_code", "latitude", "longitude", "collision_id",
+                        "number_of_persons_injured", "number_of_persons_killed",
+                        "number_of_pedestrians_injured", "number_of_pedestrians_killed",
+                        "number_of_cyclist_injured", "number_of_cyclist_killed",
+                        "number_of_motorist_injured", "number_of_motorist_killed"]
+
+# First day of the NYPD dataset.
+NYPD_FIRST_DATE = "2012-07-01"
+
+
+def collect_bike_accidents_nypd(token=None, query=None, output_file=None, page_size=50000, since=None,
+                                checkpoint_file=None, fresh=False, client=None, retries=5, backoff=1.0):
 
     """
     Collect all instances of accidents involving bikes from the NYPD public
@@ -8,54 +50,353 @@ def collect_bike_accidents_nypd(token=None, query=None, output_file=None):
     Note: Create a user specific token by registering at the following site:
     https://data.cityofnewyork.us/signup
     and use the token with Socrata for downloading the dataset without throttling.
+
+    The accidents are fetched in pages of page_size collisions ordered by collision_id and every page is appended to
+    output_file as soon as it arrives. After each page the last collision_id is stored in checkpoint_file (by default
+    output_file + ".checkpoint"), so that a later run continues where the previous one stopped. This resumes an
+    interrupted download, and once a download is complete, appends only the collisions added since. A new download
+    is collected into output_file + ".tmp" and only replaces an existing output_file once it is complete. Use
+    fresh=True for starting over, and since="YYYY-MM-DD" for collecting only crashes on or after that date. A
+    continued download keeps the since date of the run that started it, a different since date is rejected unless
+    fresh=True. Failed requests are retried up to retries times, waiting backoff seconds doubled on every attempt.
+
+    A custom SoQL query is sent as a single request as before. The Socrata client can be replaced by any object with
+    the same get method, e.g. FileClient for offline use.
+
+    Returns the collected accidents as a DataFrame if no output_file is given, otherwise the number of accidents
+    written to output_file.
     """
     import os
+    import json
     import pandas as pd
-    from sodapy import Socrata
 
     # Configure Socrata client
-    client = Socrata("data.cityofnewyork.us", token)
-
-    # Set up SoSQL query for collecting all instances involving bike accidents.
-    if query is None:
-        print("Collecting all instances of bike accidents using default query.")
-        query = """
-                select *
-                where
-                VEHICLE_TYPE_CODE1 = 'Bike' OR VEHICLE_TYPE_CODE1 = 'BICYCLE'
-                OR
-                VEHICLE_TYPE_CODE2 = 'Bike' OR VEHICLE_TYPE_CODE2 = 'BICYCLE'
-                OR
-                VEHICLE_TYPE_CODE_3 = 'Bike' OR VEHICLE_TYPE_CODE_3 = 'BICYCLE'
-                OR
-                VEHICLE_TYPE_CODE_4 = 'Bike' OR VEHICLE_TYPE_CODE_4 = 'BICYCLE'
-                OR
-                VEHICLE_TYPE_CODE_5 = 'Bike' OR VEHICLE_TYPE_CODE_5 = 'BICYCLE'
-                OR
-                NUMBER_OF_CYCLIST_INJURED > 0 OR NUMBER_OF_CYCLIST_KILLED > 0
-                limit 5000000
-                """
+    if client is None:
+        from sodapy import Socrata
+        client = Socrata("data.cityofnewyork.us", token)
+
+    if query is not None:
+        results = client.get(NYPD_DATASET, query=query)
+
+        # Converting results, a list of dictionaries, where each dictionary is an accident into a pandas dataframe.
+        df = regularize_columns(pd.DataFrame.from_records(results))
+        print("\nCollected {:} bike accidents from NYPD public dataset.".format(df.shape[0]))
+
+        if output_file is not None:
+            df.to_csv(path_or_buf=output_file, index=False)
+            print("\nOutput file {:} written.".format(output_file))
+
+        return df
+
+    print("Collecting all instances of bike accidents using default query.")
+
+    # Continue after the last collision of a previous run, if any.
+    if checkpoint_file is None and output_file is not None:
+        checkpoint_file = output_file + ".checkpoint"
+    # A download that is not continuing a complete output file is collected into a temporary file first, which
+    # replaces output_file once the download is complete. An interrupted download leaves output_file as it was.
+    tmp_file = output_file + ".tmp" if output_file is not None else None
+
+    checkpoint = None
+    if not fresh and checkpoint_file is not None and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if not os.path.exists(tmp_file if checkpoint.get("partial") else output_file):
+            checkpoint = None
+
+    last_collision_id = None
+    partial = output_file is not None
+    if checkpoint is not None:
+        # The output file only holds the crashes since the date of the run that started it.
+        if since is not None and since != checkpoint.get("since"):
+            raise ValueError("since={:} conflicts with since={:} of the download in {:}, use fresh=True (--fresh) "
+                             "for starting over with a new date".format(since, checkpoint.get("since"), output_file))
+        last_collision_id = checkpoint["last_collision_id"]
+        since = checkpoint.get("since")
+        partial = checkpoint.get("partial", False)
+        print("Continuing after collision_id {:} of a previous run.".format(last_collision_id))
+    elif partial and os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    path = tmp_file if partial else output_file
+
+    condition = "({:})".format(BIKE_ACCIDENT_CONDITION)
+    if since is not None:
+        condition += " AND crash_date >= '{:}'".format(since)
+
+    pages = []
+    n_collected = 0
+    while True:
+        where = condition
+        if last_collision_id is not None:
+            where += " AND collision_id > {:}".format(last_collision_id)
+
+        results = with_retries(lambda: client.get(NYPD_DATASET, select=", ".join(NYPD_COLUMNS), where=where,
+                                                  order="collision_id", limit=page_size),
+                               retries=retries, backoff=backoff)
+        if not results:
+            break
+
+        page = pd.DataFrame.from_records(results).reindex(columns=NYPD_COLUMNS)
+        page = regularize_columns(page)
+        last_collision_id = int(page["collision id"].astype("int64").max())
+        n_collected += page.shape[0]
+
+        if output_file is None:
+            pages.append(page)
+        else:
+            page.to_csv(path_or_buf=path, index=False, mode="a", header=not os.path.exists(path))
+            with open(checkpoint_file, "w") as f:
+                json.dump({"last_collision_id": last_collision_id, "since": since, "partial": partial}, f)
+
+        print("Collected {:} bike accidents up to collision_id {:}.".format(n_collected, last_collision_id))
+
+        if len(results) < page_size:
+            break
+
+    print("\nCollected {:} bike accidents from NYPD public dataset.".format(n_collected))
+
+    if output_file is None:
+        columns = regularize_columns(pd.DataFrame(columns=NYPD_COLUMNS)).columns
+        return pd.concat(pages, ignore_index=True) if pages else pd.DataFrame(columns=columns)
+
+    if partial:
+        if not os.path.exists(tmp_file):
+            regularize_columns(pd.DataFrame(columns=NYPD_COLUMNS)).to_csv(tmp_file, index=False)
+        os.replace(tmp_file, output_file)
+        with open(checkpoint_file, "w") as f:
+            json.dump({"last_collision_id": last_collision_id, "since": since}, f)
+
+    print("\nOutput file {:} written.".format(output_file))
+    return n_collected
+
+
+def collect_bike_accidents_partitioned(output_dir, token=None, since=None, until=None, partition="year", workers=4,
+                                       page_size=50000, retries=5, backoff=1.0, fresh=False, client=None):
+    """
+    Collect the bike accidents like collect_bike_accidents_nypd, but split by crash date into partitions (one per
+    year or month) that are fetched concurrently by a pool of worker threads, at most workers requests at a time.
+    Every partition is written to its own columnar file (Parquet if available, see frameCache.py) in output_dir as
+    soon as it is complete, named by its first day, e.g. 2023-01-01.parquet. The first partition only holds the crashes
+    on or after since.
+
+    Partitions already collected by a previous run for the same dates (kept in output_dir/partitions.json) are
+    skipped, except for the partition of the current period, which may have grown since. Use fresh=True for
+    collecting all partitions again. Failed requests are retried up to
+    retries times, waiting backoff seconds doubled on every attempt.
+
+    Returns the paths of the partition files.
+    """
+    import os
+    import json
+    import datetime
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    from preprocessing.frameCache import frame_path
+
+    if client is None:
+        from sodapy import Socrata
+        client = Socrata("data.cityofnewyork.us", token)
+
+    today = datetime.date.today().isoformat()
+    first = since or NYPD_FIRST_DATE
+    partitions = date_partitions(first, until or today, partition)
+    paths = [frame_path(os.path.join(output_dir, start)) for start, _ in partitions]
+
+    # Partitions are named by their first day, the crash dates collected for them are kept separately, as the first
+    # partition starts at since.
+    ranges_file = os.path.join(output_dir, "partitions.json")
+    ranges = {}
+    if os.path.exists(ranges_file):
+        with open(ranges_file) as f:
+            ranges = json.load(f)
+
+    # Partitions ending before today are complete and only collected once.
+    todo = [(max(start, first), end, path) for (start, end), path in zip(partitions, paths)
+            if fresh or end > today or not os.path.exists(path) or
+            ranges.get(os.path.basename(path)) != [max(start, first), end]]
+    print("Collecting {:} of {:} partitions of bike accidents with {:} workers.".format(len(todo), len(partitions),
+                                                                                       workers))
+
+    lock = threading.Lock()
+
+    def collect(start, end, path):
+        n_accidents = collect_partition(client, start, end, path, page_size, retries, backoff)
+        with lock:
+            ranges[os.path.basename(path)] = [start, end]
+            with open(ranges_file, "w") as f:
+                json.dump(ranges, f, indent=2)
+        return n_accidents
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(collect, start, end, path) for start, end, path in todo]
+        n_collected = sum(future.result() for future in futures)
+
+    print("\nCollected {:} bike accidents from NYPD public dataset into {:}.".format(n_collected, output_dir))
+    return paths
+
+
+def collect_partition(client, start, end, path, page_size=50000, retries=5, backoff=1.0):
+    """
+    Collect the bike accidents with crash dates from start up to (excluding) end, page by page, and write them to the
+    columnar file path. Returns the number of accidents collected.
+    """
+    import os
+    import pandas as pd
+
+    from preprocessing.frameCache import write_frame
+
+    condition = "({:}) AND crash_date >= '{:}' AND crash_date < '{:}'".format(BIKE_ACCIDENT_CONDITION, start, end)
+
+    pages = []
+    last_collision_id = None
+    while True:
+        where = condition
+        if last_collision_id is not None:
+            where += " AND collision_id > {:}".format(last_collision_id)
+
+        results = with_retries(lambda: client.get(NYPD_DATASET, select=", ".join(NYPD_COLUMNS), where=where,
+                                                  order="collision_id", limit=page_size),
+                               retries=retries, backoff=backoff)
+        if not results:
+            break
+
+        page = pd.DataFrame.from_records(results).reindex(columns=NYPD_COLUMNS)
+        last_collision_id = int(page["collision_id"].astype("int64").max())
+        pages.append(page)
+
+        if len(results) < page_size:
+            break
+
+    # Columns get fixed types, so that all partition files share the same schema, even where a column is empty.
+    df = pd.concat(pages, ignore_index=True) if pages else pd.DataFrame(columns=NYPD_COLUMNS)
+    for col in NYPD_COLUMNS:
+        if col in NYPD_NUMERIC_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("int64" if col == "collision_id" else "float64")
+        else:
+            df[col] = df[col].astype("string")
+    df = regularize_columns(df)
+
+    # Written under a temporary name first, so an interrupted run leaves no partial partition behind.
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    write_frame(df, tmp_path)
+    os.replace(tmp_path, path)
+
+    print("Collected {:} bike accidents from {:} to {:}.".format(df.shape[0], start, end))
+    return df.shape[0]
+
+
+def date_partitions(first, last, partition="year"):
+    """
+    Split the dates first to last (YYYY-MM-DD, both included) into consecutive years or months. Returns the first day
+    of every partition and the first day after it.
+    """
+    import pandas as pd
+
+    freq = {"year": "YS", "month": "MS"}[partition]
+    starts = pd.date_range(pd.Timestamp(first).to_period(freq[0]).start_time, last, freq=freq)
+    ends = list(starts[1:]) + [starts[-1] + pd.tseries.frequencies.to_offset(freq)]
+    return [(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")) for start, end in zip(starts, ends)]
+
+
+def with_retries(request, retries=5, backoff=1.0):
+    """
+    Call request, retrying it after connection errors, timeouts, throttling (HTTP 429) and server errors, with an
+    exponentially growing and randomized wait. Other HTTP errors, e.g. for a malformed query, are raised at once.
+    """
+    import time
+    import random
 
-    results = client.get("h9gi-nx95", query=query)
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except OSError as error:
+            response = getattr(error, "response", None)
+            status = getattr(error, "code", None) or getattr(response, "status_code", None)
+            if attempt == retries or (status is not None and status != 429 and status < 500):
+                raise
+            wait = backoff * 2**attempt * (1 + random.random())
+            print("Request failed ({:}), retrying in {:.1f} seconds.".format(error, wait))
+            time.sleep(wait)
 
-    # Converting results, a list of dictionaries, where each dictionary is an accident into a pandas dataframe.
-    df = pd.DataFrame.from_records(results)
-    print("\nCollected {:} bike accidents from NYPD public dataset.".format(df.shape[0]))
 
+def regularize_columns(df):
+    """
+    Regularize the column names of the NYPD dataset.
+    """
     # Correcting few column names
-    df.rename(columns={"vehicle_type_code1": "vehicle_type_code_1",
-                       "vehicle_type_code2": "vehicle_type_code_2"}, inplace=True)
+    df = df.rename(columns={"vehicle_type_code1": "vehicle_type_code_1",
+                            "vehicle_type_code2": "vehicle_type_code_2"})
 
     # Regularizing column names by removing underscores.
     df.columns = df.columns.str.replace('_', ' ')
 
-    if output_file is not None:
-        df.to_csv(path_or_buf=output_file, index=False)
-        print("\nOutput file {:} written.".format(output_file))
-
     return df
 
 
+class SoqlClient:
+    """
+    Minimal client for the SoQL API of a Socrata site at base_url, with the same get method as the Socrata client of
+    sodapy. It needs no extra packages, and base_url can point at any server answering SoQL requests, e.g. a mirror
+    or a local stand-in, over http or https.
+    """
+
+    def __init__(self, base_url="https://data.cityofnewyork.us", token=None, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def get(self, dataset_identifier, query=None, select=None, where=None, order=None, limit=None):
+        import json
+        import urllib.parse
+        import urllib.request
+
+        if query is not None:
+            params = {"$query": query}
+        else:
+            params = {"$select": select, "$where": where, "$order": order, "$limit": limit}
+        params = urllib.parse.urlencode({key: value for key, value in params.items() if value is not None})
+
+        url = "{:}/resource/{:}.json?{:}".format(self.base_url, dataset_identifier, params)
+        headers = {"X-App-Token": self.token} if self.token is not None else {}
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+            return json.load(response)
+
+
+class FileClient:
+    """
+    File backed stand-in for the Socrata client, serving bike accidents stored in a json file as a list of records
+    in the format returned by Socrata. The records are assumed to be bike accidents already, so of a where condition
+    only the parts "collision_id > N", "crash_date >= 'YYYY-MM-DD'" and "crash_date < 'YYYY-MM-DD'" are applied.
+    """
+
+    def __init__(self, filepath):
+        import json
+
+        with open(filepath) as f:
+            self.records = json.load(f)
+
+    def get(self, dataset_identifier, query=None, select=None, where=None, order=None, limit=None):
+        import re
+
+        records = sorted(self.records, key=lambda record: int(record["collision_id"]))
+
+        match = re.search(r"collision_id > (\d+)", where or "")
+        if match:
+            records = [record for record in records if int(record["collision_id"]) > int(match.group(1))]
+
+        match = re.search(r"crash_date >= '([^']+)'", where or "")
+        if match:
+            records = [record for record in records if record["crash_date"][:10] >= match.group(1)]
+
+        match = re.search(r"crash_date < '([^']+)'", where or "")
+        if match:
+            records = [record for record in records if record["crash_date"][:10] < match.group(1)]
+
+        return records[:limit]
+
+
 if __name__ == "__main__":
 
     import argparse
@@ -65,12 +406,45 @@ if __name__ == "__main__":
     my_parser.add_argument("--token", type=str, help="Your token for downloading data")
     my_parser.add_argument("--output", type=str, help="Output filename for storing data")
     my_parser.add_argument("--query", type=str, help="SoSQL query string")
+    my_parser.add_argument("--page-size", type=int, default=50000, help="Number of accidents fetched per request")
+    my_parser.add_argument("--since", type=str,
+                           help="Collect only crashes on or after this date (YYYY-MM-DD). A continued download keeps "
+                                "the date it was started with, use --fresh for changing it")
+    my_parser.add_argument("--checkpoint", type=str, help="Checkpoint file (default: output filename + .checkpoint)")
+    my_parser.add_argument("--fresh", action="store_true", help="Ignore the checkpoint and download everything again")
+    my_parser.add_argument("--fixture", type=str, help="Serve accidents from this json file instead of Socrata")
+    my_parser.add_argument("--base-url", type=str,
+                           help="Fetch from the SoQL API at this URL (e.g. http://localhost:8000) instead of "
+                                "https://data.cityofnewyork.us through sodapy")
+    my_parser.add_argument("--output-dir", type=str,
+                           help="Collect the accidents concurrently in date partitions, one columnar file per "
+                                "partition in this folder, instead of into a single csv file")
+    my_parser.add_argument("--partition", type=str, choices=["year", "month"], default="year",
+                           help="Date range of a partition for --output-dir")
+    my_parser.add_argument("--until", type=str, help="Collect only the partitions up to this date (YYYY-MM-DD), for "
+                                                     "--output-dir")
+    my_parser.add_argument("--workers", type=int, default=4,
+                           help="Number of partitions fetched at the same time, for --output-dir")
+    my_parser.add_argument("--retries", type=int, default=5,
+                           help="Number of retries of a failed request, with exponentially growing waits")
 
     args = my_parser.parse_args()
 
     input_token = args.token
     input_query = args.query
     output_filename = args.output
+    input_client = None
+    if args.fixture is not None:
+        input_client = FileClient(args.fixture)
+    elif args.base_url is not None:
+        input_client = SoqlClient(args.base_url, args.token)
 
-    collect_bike_accidents_nypd(token=input_token, query=input_query, output_file=output_filename)
+    if args.output_dir is not None:
+        collect_bike_accidents_partitioned(args.output_dir, token=input_token, since=args.since, until=args.until,
+                                           partition=args.partition, workers=args.workers, page_size=args.page_size,
+                                           retries=args.retries, fresh=args.fresh, client=input_client)
+        raise SystemExit
 
+    collect_bike_accidents_nypd(token=input_token, query=input_query, output_file=output_filename,
+                                page_size=args.page_size, since=args.since, checkpoint_file=args.checkpoint,
+                                fresh=args.fresh, client=input_client, retries=args.retries)
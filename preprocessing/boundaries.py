@@ -0,0 +1,270 @@
+"""
+Boundary based geocoding: assigning zipcodes and boroughs to (latitude, longitude) positions from the polygons of
+the zipcode and borough areas instead of from the nearest zipcode centroid.
+
+The polygons are read from a local GeoJSON file, e.g. the NYC borough boundaries or ZIP code tabulation areas from
+https://data.cityofnewyork.us. A rasterized lookup grid is precomputed over them: cells lying entirely inside one
+polygon (or outside all of them) are resolved by a single array lookup, and only positions in cells crossed by a
+polygon edge are tested exactly against the edges of their latitude band.
+"""
+
+
+# Property names holding the borough and the zipcode in commonly published NYC boundary files.
+BOROUGH_PROPERTIES = ["borough", "boro_name", "BoroName", "BORONAME", "boroname"]
+ZIPCODE_PROPERTIES = ["postalCode", "ZIPCODE", "zipcode", "modzcta", "MODZCTA", "ZCTA5CE20", "ZCTA5CE10"]
+
+
+class PolygonIndex:
+    """
+    Point in polygon index over a set of polygons using a rasterized lookup grid.
+
+    Every polygon is a list of rings (outer boundaries and holes), every ring an array of (longitude, latitude)
+    vertices. A position is inside a polygon if a ray from it crosses the rings of the polygon an odd number of times,
+    so holes and multi-part polygons need no special treatment. Where polygons overlap, the one that comes first wins.
+    """
+
+    def __init__(self, polygons, cellsize=0.002, block=1 << 22):
+        import numpy as np
+
+        self.block = block
+        self.n_polygons = len(polygons)
+
+        # Collect the edges of all rings together with the polygon they belong to.
+        x0, y0, x1, y1, owner = [], [], [], [], []
+        for i, rings in enumerate(polygons):
+            for ring in rings:
+                ring = np.asarray(ring, dtype=np.float64)[:, :2]
+                if ring.shape[0] < 2:
+                    continue
+                closed = np.vstack([ring, ring[:1]])
+                x0.append(closed[:-1, 0])
+                y0.append(closed[:-1, 1])
+                x1.append(closed[1:, 0])
+                y1.append(closed[1:, 1])
+                owner.append(np.full(ring.shape[0], i, dtype=np.int64))
+
+        x0, y0, x1, y1 = (np.concatenate(a) if a else np.empty(0) for a in (x0, y0, x1, y1))
+        owner = np.concatenate(owner) if owner else np.empty(0, dtype=np.int64)
+        keep = (x0 != x1) | (y0 != y1)
+        x0, y0, x1, y1, owner = x0[keep], y0[keep], x1[keep], y1[keep], owner[keep]
+
+        self.cellsize = cellsize
+        if owner.shape[0] == 0:
+            self.nlat = self.nlon = 0
+            return
+
+        self.minlon, self.minlat = min(x0.min(), x1.min()), min(y0.min(), y1.min())
+        maxlon, maxlat = max(x0.max(), x1.max()), max(y0.max(), y1.max())
+        self.nlon = int(np.floor((maxlon - self.minlon) / cellsize)) + 1
+        self.nlat = int(np.floor((maxlat - self.minlat) / cellsize)) + 1
+
+        # Cells touched by the bounding box of an edge are boundary cells, all other cells are entirely inside one
+        # polygon or outside all of them.
+        col0, col1 = self._cols(np.minimum(x0, x1)), self._cols(np.maximum(x0, x1))
+        row0, row1 = self._rows(np.minimum(y0, y1)), self._rows(np.maximum(y0, y1))
+        edge, k = expand_ranges((row1 - row0 + 1) * (col1 - col0 + 1))
+        ncols = col1[edge] - col0[edge] + 1
+        boundary = np.zeros((self.nlat, self.nlon), dtype=bool)
+        boundary[row0[edge] + k // ncols, col0[edge] + k % ncols] = True
+
+        # Edges of every latitude band (grid row), grouped by polygon. Horizontal edges are never crossed by a
+        # horizontal ray and are left out.
+        sloped = np.flatnonzero(y0 != y1)
+        edge, k = expand_ranges(row1[sloped] - row0[sloped] + 1)
+        edge = sloped[edge]
+        band = row0[edge] + k
+        order = np.lexsort((owner[edge], band))
+        edge, band = edge[order], band[order]
+        self.band_offsets = np.concatenate([[0], np.cumsum(np.bincount(band, minlength=self.nlat))])
+        self.x0, self.y0, self.x1, self.y1, self.owner = x0[edge], y0[edge], x1[edge], y1[edge], owner[edge]
+
+        # Label every cell by the polygon containing its center, -2 marks the boundary cells.
+        self.labels = np.full((self.nlat, self.nlon), -2, dtype=np.int64)
+        center_lon = self.minlon + cellsize * (np.arange(self.nlon) + 0.5)
+        for row in range(self.nlat):
+            cols = np.flatnonzero(~boundary[row])
+            center_lat = np.full(cols.shape[0], self.minlat + cellsize * (row + 0.5))
+            self.labels[row, cols] = self._locate_in_band(row, center_lat, center_lon[cols])
+
+    def _rows(self, lat):
+        import numpy as np
+
+        return np.clip(np.floor((lat - self.minlat) / self.cellsize), 0, self.nlat - 1).astype(np.int64)
+
+    def _cols(self, lon):
+        import numpy as np
+
+        return np.clip(np.floor((lon - self.minlon) / self.cellsize), 0, self.nlon - 1).astype(np.int64)
+
+    def _locate_in_band(self, row, lat, lon):
+        """
+        Exact point in polygon test for positions in the latitude band row, counting the crossings of a ray to the
+        east with the edges of the band.
+        """
+        import numpy as np
+
+        ind = np.full(lat.shape[0], -1, dtype=np.int64)
+        start, stop = self.band_offsets[row], self.band_offsets[row + 1]
+        if start == stop or lat.shape[0] == 0:
+            return ind
+
+        x0, y0 = self.x0[start:stop], self.y0[start:stop]
+        x1, y1 = self.x1[start:stop], self.y1[start:stop]
+        owner = self.owner[start:stop]
+        owner_starts = np.flatnonzero(np.diff(owner, prepend=-1))
+
+        step = max(1, self.block // (stop - start))
+        for first in range(0, lat.shape[0], step):
+            y = lat[first:first + step, None]
+            x = lon[first:first + step, None]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cross = ((y0 > y) != (y1 > y)) & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+            inside = np.add.reduceat(cross, owner_starts, axis=1) % 2 == 1
+            found = inside.any(axis=1)
+            ind[first:first + step] = np.where(found, owner[owner_starts][inside.argmax(axis=1)], -1)
+
+        return ind
+
+    def query(self, lat, lon):
+        """
+        Find the polygon containing every position. Returns the index of the polygon, or -1 for positions outside
+        all polygons or with missing coordinates.
+        """
+        import numpy as np
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        ind = np.full(lat.shape[0], -1, dtype=np.int64)
+        if self.nlat == 0:
+            return ind
+
+        with np.errstate(invalid="ignore"):
+            row = np.floor((lat - self.minlat) / self.cellsize)
+            col = np.floor((lon - self.minlon) / self.cellsize)
+            inside = (row >= 0) & (row < self.nlat) & (col >= 0) & (col < self.nlon)
+
+        pos = np.flatnonzero(inside)
+        row, col = row[pos].astype(np.int64), col[pos].astype(np.int64)
+        ind[pos] = self.labels[row, col]
+
+        # Positions in boundary cells are grouped by latitude band and tested exactly.
+        exact = ind[pos] == -2
+        pos, row = pos[exact], row[exact]
+        order = np.argsort(row, kind="stable")
+        pos, row = pos[order], row[order]
+        bounds = np.flatnonzero(np.diff(row)) + 1
+        for group in np.split(np.arange(pos.shape[0]), bounds):
+            if group.shape[0]:
+                p = pos[group]
+                ind[p] = self._locate_in_band(row[group[0]], lat[p], lon[p])
+
+        return ind
+
+
+def expand_ranges(counts):
+    """
+    For ranges of the given lengths, return the range of every element and its position within the range.
+    """
+    import numpy as np
+
+    counts = np.asarray(counts, dtype=np.int64)
+    ind = np.repeat(np.arange(counts.shape[0]), counts)
+    return ind, np.arange(ind.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+class Boundaries:
+    """
+    Zipcode and borough areas with a PolygonIndex over them. Either the zipcodes or the boroughs may be missing
+    (None) when the boundary file does not provide them.
+    """
+
+    def __init__(self, polygons, zipcodes=None, boroughs=None, cellsize=0.002):
+        import numpy as np
+
+        self.index = PolygonIndex(polygons, cellsize=cellsize)
+        self.zipcodes = None if zipcodes is None else np.asarray(zipcodes, dtype=np.int64)
+        self.boroughs = None if boroughs is None else np.asarray(boroughs, dtype=object)
+
+    def locate(self, lat, lon):
+        """
+        Zipcode and borough for every position. Zipcodes are -1 and boroughs None where they are unknown.
+        """
+        import numpy as np
+
+        ind = self.index.query(lat, lon)
+        inside = ind >= 0
+
+        zipcode = np.full(ind.shape[0], -1, dtype=np.int64)
+        borough = np.full(ind.shape[0], None, dtype=object)
+        if self.zipcodes is not None:
+            zipcode[inside] = self.zipcodes[ind[inside]]
+        if self.boroughs is not None:
+            borough[inside] = self.boroughs[ind[inside]]
+
+        return zipcode, borough
+
+
+def read_boundaries(filepath, cellsize=0.002):
+    """
+    Read the zipcode and/or borough areas from a GeoJSON file of Polygon and MultiPolygon features. Borough names are
+    upper-cased to match the borough names of the NYPD dataset (e.g. "STATEN ISLAND").
+    """
+    import json
+
+    with open(filepath) as f:
+        features = json.load(f)["features"]
+
+    polygons, zipcodes, boroughs = [], [], []
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            rings = geometry["coordinates"]
+        elif geometry.get("type") == "MultiPolygon":
+            rings = [ring for polygon in geometry["coordinates"] for ring in polygon]
+        else:
+            continue
+
+        properties = feature.get("properties") or {}
+        zipcode = next((properties[name] for name in ZIPCODE_PROPERTIES if properties.get(name) is not None), None)
+        borough = next((properties[name] for name in BOROUGH_PROPERTIES if properties.get(name) is not None), None)
+
+        polygons.append(rings)
+        zipcodes.append(parse_zipcode(zipcode))
+        boroughs.append(str(borough).strip().upper() if borough is not None else None)
+
+    if not polygons:
+        raise ValueError("No Polygon or MultiPolygon features found in {:}".format(filepath))
+
+    has_zipcodes = any(zipcode >= 0 for zipcode in zipcodes)
+    has_boroughs = any(borough is not None for borough in boroughs)
+    if not has_zipcodes and not has_boroughs:
+        raise ValueError("The features in {:} have none of the zipcode properties {:} or borough properties "
+                         "{:}".format(filepath, ZIPCODE_PROPERTIES, BOROUGH_PROPERTIES))
+
+    return Boundaries(polygons, zipcodes if has_zipcodes else None, boroughs if has_boroughs else None,
+                      cellsize=cellsize)
+
+
+def parse_zipcode(value):
+    """
+    Zipcode as an integer, or -1 if it is missing or not numeric.
+    """
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return -1
+
+
+_loaded_boundaries = {}
+
+
+def load_boundaries(filepath):
+    """
+    Read the boundary file once per process and reuse the index for later calls.
+    """
+    import os
+
+    key = os.path.abspath(filepath)
+    if key not in _loaded_boundaries:
+        _loaded_boundaries[key] = read_boundaries(filepath)
+    return _loaded_boundaries[key]
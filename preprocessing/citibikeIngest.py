@@ -0,0 +1,291 @@
+"""
+Streaming ingestion of CitiBike trip files, unpacked or as the zip archives they are published in.
+
+Trip files are read in chunks keeping only the columns needed for geocoding, every chunk is assigned a zipcode and
+borough, and is then folded into rental rollups per month (see rollups.py). Memory use is bounded by the chunk size
+and not by the number of files processed. Trips are deduplicated by their ride id against earlier chunks and earlier
+trip files (see dedup.py).
+"""
+
+
+# Columns needed for determining where the bikes were rented.
+CITIBIKE_COLUMNS = ["start_station_id", "start_lat", "start_lng"]
+
+
+def find_citibike_files(folder):
+    """
+    Find the CitiBike trip files in folder, both unpacked .csv files and .zip archives as downloaded.
+    Archives whose csv files are all present unpacked in the folder as well are skipped.
+    """
+    import os
+    import glob
+
+    csv_files = sorted(glob.glob(os.path.join(folder, "*.csv")))
+    unpacked = {os.path.basename(file) for file in csv_files}
+
+    zip_files = []
+    for file in sorted(glob.glob(os.path.join(folder, "*.zip"))):
+        members = {os.path.basename(member) for member in list_zip_csv_members(file)}
+        if not members or not members <= unpacked:
+            zip_files.append(file)
+
+    return csv_files + zip_files
+
+
+def select_citibike_files(files, months=None):
+    """
+    Keep the trip files of the months in the range months = (first, last), both given as "YYYY-MM". Files are matched
+    by the date their names start with, YYYYMM for monthly files and YYYY for yearly archives. Files without such a
+    date are kept.
+    """
+    import os
+    import re
+
+    if months is None:
+        return list(files)
+
+    first, last = [month.replace("-", "") for month in months]
+
+    selected = []
+    for file in files:
+        match = re.match(r"(\d{6}|\d{4})(?!\d)", os.path.basename(file))
+        if match is None:
+            selected.append(file)
+            continue
+
+        date = match.group(1)
+        if len(date) == 6 and first <= date <= last:
+            selected.append(file)
+        elif len(date) == 4 and first[:4] <= date <= last[:4]:
+            selected.append(file)
+
+    return selected
+
+
+def list_zip_csv_members(file):
+    """
+    List the csv files inside a zip archive, ignoring macOS metadata.
+    """
+    import zipfile
+
+    with zipfile.ZipFile(file) as archive:
+        return [member for member in archive.namelist()
+                if member.lower().endswith(".csv") and not member.startswith("__MACOSX")]
+
+
+def iter_csv_streams(file):
+    """
+    Yield readable streams of the csv files in file, which is either a csv file or a zip archive. Archives are read
+    member by member without unpacking them to disk, zip archives nested inside archives included.
+    """
+    import zipfile
+
+    if not zipfile.is_zipfile(file):
+        yield file
+        return
+
+    with zipfile.ZipFile(file) as archive:
+        for member in sorted(archive.namelist()):
+            if member.startswith("__MACOSX"):
+                continue
+            if member.lower().endswith(".csv"):
+                with archive.open(member) as stream:
+                    yield stream
+            elif member.lower().endswith(".zip"):
+                with archive.open(member) as stream:
+                    yield from iter_csv_streams(stream)
+
+
+def iter_citibike_chunks(files, chunksize=500000, usecols=CITIBIKE_COLUMNS):
+    """
+    Read the CitiBike trip files (csv files or zip archives of csv files) chunk by chunk, keeping only the columns
+    in usecols.
+    """
+    import pandas as pd
+
+    from preprocessing.schema import TRIP_READ_DTYPES
+
+    for file in files:
+        for stream in iter_csv_streams(file):
+            # Station ids are read as strings (categories) so that every chunk builds the same station keys.
+            reader = pd.read_csv(stream, usecols=lambda col: col in usecols, dtype=TRIP_READ_DTYPES,
+                                 chunksize=chunksize)
+            for chunk in reader:
+                yield chunk
+
+
+def rollup_rentals_in_file(file, stations, chunksize=500000, boundaries=None, key_dir=None, earlier=()):
+    """
+    Reduce a single trip file to rental rollups per month, borough, zipcode, hour of the week and rideable type
+    (see rollups.py), and to hourly rental rollups per borough. Returns both rollups, the number of geocoded trips and
+    the extended table of stations.
+
+    Trips whose ride id occurs earlier in the file, or in the key runs (in key_dir) of the earlier files, are dropped.
+    """
+    import pandas as pd
+
+    from preprocessing.dedup import KeyRuns, KeySet, drop_duplicate_trips, RIDE_KEY
+    from preprocessing.determine_zipcode_borough_for_CitiBike import assign_station_zipcode_borough
+    from preprocessing.rollups import merge_rollups, rollup_trips, rollup_trips_hourly, RENTAL_KEYS, HOURLY_KEYS
+    from preprocessing.rollups import ROLLUP_TRIP_COLUMNS
+
+    seen = KeyRuns(key_dir).key_set(earlier) if key_dir is not None else KeySet()
+
+    partials, hourly = [], []
+    n_trips = 0
+    n_duplicates = 0
+    for chunk in iter_citibike_chunks([file], chunksize=chunksize, usecols=ROLLUP_TRIP_COLUMNS + [RIDE_KEY]):
+        chunk, n_dropped = drop_duplicate_trips(chunk, seen)
+        chunk, stations = assign_station_zipcode_borough(chunk, stations, boundaries=boundaries)
+        chunk["started_at"] = pd.to_datetime(chunk["started_at"])
+        partials.append(rollup_trips(chunk))
+        hourly.append(rollup_trips_hourly(chunk))
+        n_trips += chunk.shape[0]
+        n_duplicates += n_dropped
+
+    print("Rolled up {:} CitiBike trips from {:} ({:} duplicate trips dropped).".format(n_trips, file, n_duplicates))
+
+    rollup = merge_rollups(partials, ["month"] + RENTAL_KEYS)
+    return rollup, merge_rollups(hourly, ["month"] + HOURLY_KEYS), n_trips, stations
+
+
+def update_ride_keys(files, key_dir, chunksize=500000, workers=1):
+    """
+    Bring the key runs (sorted ride id hashes, see dedup.py) of the trip files up to date, together with the pairs of
+    sources sharing ride ids. Runs of sources whose file no longer exists are dropped.
+
+    Returns, for every file, the fingerprints of the earlier files among the given files sharing ride ids with it,
+    i.e. of the files owning some of its trips, and the names of the sources dropped.
+    """
+    import os
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    from preprocessing.dedup import KeyRuns, read_ride_keys
+    from preprocessing.frameCache import content_hash
+    from preprocessing.pipeline import file_fingerprint
+
+    key_runs = KeyRuns(key_dir)
+    sources_file = os.path.join(key_dir, "sources.json")
+    sources = {}
+    if os.path.exists(sources_file):
+        with open(sources_file) as f:
+            sources = {name: entry for name, entry in json.load(f).items() if isinstance(entry, dict)}
+
+    # Sources are kept while their file exists, so that files left out by the selected months keep their runs.
+    removed = sorted(name for name, entry in sources.items() if not os.path.exists(entry["path"]))
+    for name in removed:
+        del sources[name]
+        if key_runs.exists(name):
+            os.remove(key_runs.path(name))
+    for entry in sources.values():
+        entry["overlaps"] = [other for other in entry["overlaps"] if other in sources]
+
+    code_key = content_hash([])
+    fingerprints = {os.path.basename(file): file_fingerprint([file]) + code_key for file in files}
+    changed = [file for file in files if not key_runs.exists(os.path.basename(file)) or
+               sources.get(os.path.basename(file), {}).get("fingerprint") != fingerprints[os.path.basename(file)]]
+
+    if workers > 1 and len(changed) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            runs = list(executor.map(read_ride_keys, changed, [chunksize] * len(changed)))
+    else:
+        runs = [read_ride_keys(file, chunksize) for file in changed]
+
+    # The pairs of a changed source are found again by comparing its new run with the runs of all other sources.
+    for file, run in zip(changed, runs):
+        name = os.path.basename(file)
+        key_runs.write(name, run)
+        for entry in sources.values():
+            entry["overlaps"] = [other for other in entry["overlaps"] if other != name]
+        overlaps = key_runs.overlaps(name, [other for other in sources if other != name])
+        for other in overlaps:
+            sources[other]["overlaps"].append(name)
+        sources[name] = {"path": os.path.abspath(file), "fingerprint": fingerprints[name], "overlaps": overlaps}
+
+    os.makedirs(key_dir, exist_ok=True)
+    with open(sources_file, "w") as f:
+        json.dump(sources, f, indent=2)
+
+    earlier = {name: {other: sources[other]["fingerprint"] for other in sorted(sources[name]["overlaps"])
+                      if other < name and other in fingerprints} for name in fingerprints}
+    return earlier, removed
+
+
+def update_rental_rollups(files, rollup_dir, chunksize=500000, cache_file="citibike-station-zipcodes.csv", workers=1,
+                          boundaries=None):
+    """
+    Bring the rental rollups of the trip files up to date. Files whose rollups were built from the same file
+    (size and modification time), zipcode file, boundaries and preprocessing code are skipped, the others are rolled
+    up, in parallel by a pool of worker processes if workers > 1.
+
+    Trips are deduplicated by ride id across the given trip files: a trip is only counted for the first file (in name
+    order) containing it, so ingesting overlapping or re-downloaded files again does not change the rollups. The
+    rollups of a file are rebuilt as well when the earlier files sharing ride ids with it change, are added or are
+    left out.
+    """
+    import os
+    import json
+    import hashlib
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+
+    from preprocessing.determine_zipcode_borough_for_CitiBike import load_station_cache, save_station_cache
+    from preprocessing.determine_zipcode_borough_for_CitiBike import station_cache_key, STATION_KEY_COLUMNS
+    from preprocessing.frameCache import content_hash
+    from preprocessing.pipeline import file_fingerprint
+    from preprocessing.rollups import write_rollups, remove_rollups
+
+    sources_file = os.path.join(rollup_dir, "rentals", "sources.json")
+    sources = {}
+    if os.path.exists(sources_file):
+        with open(sources_file) as f:
+            sources = json.load(f)
+
+    key_dir = os.path.join(rollup_dir, "ride_keys")
+    owners, removed = update_ride_keys(files, key_dir, chunksize, workers)
+    for name in removed:
+        for rollup in ("rentals", "rentals_hourly"):
+            remove_rollups(rollup_dir, rollup, name)
+        sources.pop(name, None)
+
+    # The rollups of a file depend on the file, the boundaries, the code and the earlier files owning some of its trips.
+    code_key = content_hash([]) + station_cache_key(boundaries)
+    fingerprints = {}
+    for file in files:
+        owner_key = hashlib.sha1(json.dumps(owners[os.path.basename(file)], sort_keys=True).encode()).hexdigest()
+        fingerprints[file] = file_fingerprint([file]) + code_key + owner_key
+    outdated = [file for file in files if sources.get(os.path.basename(file)) != fingerprints[file]]
+    if not outdated and not removed:
+        return
+
+    stations = load_station_cache(cache_file, boundaries)
+    n_stations = stations.shape[0]
+
+    earlier = [list(owners[os.path.basename(file)]) for file in outdated]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(rollup_rentals_in_file, file, stations, chunksize, boundaries, key_dir, before)
+                       for file, before in zip(outdated, earlier)]
+            partials = [future.result() for future in futures]
+        stations = pd.concat([stations] + [partial[3] for partial in partials], ignore_index=True)
+        stations = stations.drop_duplicates(subset=STATION_KEY_COLUMNS, ignore_index=True)
+    else:
+        partials = []
+        for file, before in zip(outdated, earlier):
+            partial = rollup_rentals_in_file(file, stations, chunksize, boundaries, key_dir, before)
+            stations = partial[3]
+            partials.append(partial)
+
+    for file, partial in zip(outdated, partials):
+        write_rollups(partial[0], rollup_dir, "rentals", os.path.basename(file))
+        write_rollups(partial[1], rollup_dir, "rentals_hourly", os.path.basename(file))
+        sources[os.path.basename(file)] = fingerprints[file]
+
+    os.makedirs(os.path.dirname(sources_file), exist_ok=True)
+    with open(sources_file, "w") as f:
+        json.dump(sources, f, indent=2)
+
+    if stations.shape[0] > n_stations:
+        save_station_cache(stations, cache_file, boundaries)
@@ -1,25 +1,57 @@
 def clean_data(df):
     """
     Function for cleaning the bike accident dataset.
+    Accidents without a cyclist involved are removed first, so the string processing only runs on the remaining rows
+    and only once per distinct value of a column.
     """
 
-    import pandas as pd
     import numpy as np
 
+    from preprocessing.dedup import drop_duplicate_keys
+
+    # Regularize the columns "number of persons injured" and "number of persons killed"
+    # They have some missing values, and we correct them here. The corrections go to the first two missing entries in
+    # time order, so only the timestamps of the missing entries are parsed to find them.
+    na_rows = np.flatnonzero(df["number of persons injured"].isna().to_numpy())
+    na_dt = parse_crash_datetime(df["crash date"].iloc[na_rows], df["crash time"].iloc[na_rows])
+    na_rows = df.index[na_rows[np.argsort(na_dt.to_numpy(), kind="stable")]]
+
+    for row, num_injured in zip(na_rows[:2], [0, 1]):
+        df.loc[row, "number of persons injured"] = num_injured
+        df.loc[row, "number of persons killed"] = 0
+
+    # Remove all the accident instances where no cyclist is involved.
+    # For this we assume that in the vehicle column "bike" should be present or
+    # there should be either an injury or death of a cyclist.
+    # The vehicle column is categorical, so "bike" is searched once per category and looked up by the category codes.
+    # Accidents with a missing vehicle type are not retained.
+    vehicles = df["vehicle type code 1"].astype("category")
+    vehicle_codes = vehicles.cat.codes.to_numpy()
+    bike_categories = np.append(vehicles.cat.categories.astype(str).str.contains("bike"), False)
+    has_bike = bike_categories[vehicle_codes]
+
+    cyclist_mask = ((df["number of cyclist injured"] > 0) | (df["number of cyclist killed"] > 0)).to_numpy()
+
+    # Join masks, that is, combine them.
+    the_mask = (has_bike | cyclist_mask) & (vehicle_codes >= 0)
+
+    # Filter and retain only the rows needed.
+    df = df.loc[the_mask].copy()
+
     # Arrange columns in alphabetical order.
-    df.sort_index(axis=1, inplace=True)
+    df = df[sorted(df.columns)]
 
     # Remove the redundant column "Location" as latitude and longitude information is already available.
-    df.drop(columns="location", inplace=True)
+    # Remove the column "off-street name" as most instances are missing value.
+    df.drop(columns=["location", "off street name"], inplace=True)
 
     # Format date and time into datetime64 format.
-    crash_dt = df["crash date"] + " " + df["crash time"]
-    crash_dt = pd.to_datetime(crash_dt)
+    crash_dt = parse_crash_datetime(df["crash date"], df["crash time"])
     df.insert(0, "datetime", crash_dt)
     df.drop(columns=["crash date", "crash time"], inplace=True)
 
     # Arrange the accidents by timestamp.
-    df.sort_values(by="datetime", inplace=True, ignore_index=True)
+    df.sort_values(by="datetime", inplace=True, ignore_index=True, kind="stable")
 
     # Remove missing positions.
     mask = (df["latitude"] < 35) | (df["longitude"] > -65)
@@ -27,56 +59,56 @@ def clean_data(df):
     df.loc[mask, "longitude"] = np.nan
 
     # Regularize contributing factors.
-    mask = df["contributing factor vehicle 1"].str.fullmatch("illnes", case=False)
-    mask.fillna(False, inplace=True)
-    df.loc[mask, "contributing factor vehicle 1"] = "Illness"
-
-    # Remove the column "off-street name" as most instances are missing value.
-    df.drop(columns="off street name", inplace=True)
+    df["contributing factor vehicle 1"] = map_unique(
+        df["contributing factor vehicle 1"],
+        lambda values: values.mask(values.str.fullmatch("illnes", case=False).fillna(False), "Illness"))
 
     # Regularize the street names by Titlizing them.
-    df["on street name"] = df["on street name"].str.title()
-    df["cross street name"] = df["cross street name"].str.title()
+    df["on street name"] = map_unique(df["on street name"], lambda values: values.str.title())
+    df["cross street name"] = map_unique(df["cross street name"], lambda values: values.str.title())
 
     # Regularize borough names by capitalizing them.
-    df["borough"] = df["borough"].str.capitalize()
+    df["borough"] = map_unique(df["borough"], lambda values: values.str.capitalize())
 
-    # Regularize the columns "number of persons injured" and "number of persons killed"
-    # They have some missing values, and we correct them here.
-    na_rows = df["number of persons injured"].isna()
-    na_rows = df.loc[na_rows, :].index
+    df["number of persons injured"] = df["number of persons injured"].astype("Int64")
+    df["number of persons killed"] = df["number of persons killed"].astype("int")
 
-    df.loc[na_rows[0], "number of persons injured"] = 0
-    df.loc[na_rows[0], "number of persons killed"] = 0
+    # Remove accidents collected more than once, e.g. by overlapping downloads. Only the collision ids are compared.
+    df = drop_duplicate_keys(df, "collision id")
 
-    df.loc[na_rows[1], "number of persons injured"] = 1
-    df.loc[na_rows[1], "number of persons killed"] = 0
+    return df
 
-    df["number of persons injured"] = df["number of persons injured"].astype("Int64")
-    df["number of persons killed"] = df["number of persons killed"].astype("int")
 
-    # Remove all the accident instances where no cyclist is involved.
-    # For this we assume that in the vehicle column "bike" should be present or
-    # there should be either an injury or death of a cyclist.
+def map_unique(series, func):
+    """
+    Apply func to the distinct values of a column only and map the results back to all rows. Missing values are kept.
+    """
 
-    col_ind = df.columns.str.match("vehicle_type")
-    cols = df.columns[col_ind].tolist()
+    import pandas as pd
+    import numpy as np
 
-    new_str = df["vehicle type code 1"]
-    for col in cols[1:]:
-        new_str = new_str.str.cat(df[col], sep=",", na_rep="")
+    codes, uniques = pd.factorize(series)
+    values = func(pd.Series(np.asarray(uniques, dtype=object))).to_numpy(dtype=object)
 
-    has_bike = new_str.str.contains("bike")
+    return pd.Series(np.where(codes >= 0, values[codes] if len(values) else np.nan, np.nan), index=series.index,
+                     dtype=object)
 
-    cyclist_mask = (df["number of cyclist injured"] > 0) | (df["number of cyclist killed"] > 0)
 
-    # Join masks, that is, combine them.
-    the_mask = has_bike | cyclist_mask
+def parse_crash_datetime(crash_date, crash_time):
+    """
+    Combine the columns crash date and crash time (H:MM or H:MM:SS) into datetime64. Every distinct date and time is only parsed
+    once, as there are far fewer of them than accidents.
+    """
 
-    # Filter and retain only the rows needed.
-    df = df.loc[the_mask]
+    import pandas as pd
 
-    df.drop_duplicates(inplace=True, ignore_index=True)
+    date_codes, dates = pd.factorize(crash_date)
+    time_codes, times = pd.factorize(crash_time)
 
-    return df
+    dates = pd.to_datetime(pd.Series(dates, dtype=object)).dt.normalize()
+    times = pd.Series(times, dtype=object)
+    times = pd.to_timedelta(times.where(times.str.count(":") > 1, times + ":00"))
+
+    crash_dt = dates.array.take(date_codes, allow_fill=True) + times.array.take(time_codes, allow_fill=True)
 
+    return pd.Series(crash_dt, index=crash_date.index)
@@ -0,0 +1,166 @@
+"""
+Bounded-memory deduplication of the CitiBike trips by ride_id and of the bike accidents by collision id.
+
+Keys are reduced to 64-bit hashes, so memory grows with the number of keys (8 bytes each) and not with the width of
+the rows. The distinct keys of every trip file are kept on disk as a sorted run
+    <key_dir>/<source>.npy
+which is memory mapped and searched by binary search when later files are checked against it. A trip belongs to the
+first of the files processed (in name order) containing it: rows whose key occurs earlier in the same file or in an
+earlier file are duplicates, e.g. of a re-downloaded month or of a monthly file also contained in a yearly archive.
+"""
+
+
+# Key column of the CitiBike trips. Trip files of the older format have no ride ids and are not deduplicated.
+RIDE_KEY = "ride_id"
+
+
+def hash_keys(values):
+    """
+    64-bit hashes of the keys in values (any array or Series). Missing keys are marked by the second array returned.
+    """
+    import numpy as np
+    import pandas as pd
+
+    values = np.asarray(values, dtype=object)
+    return pd.util.hash_array(values, categorize=True), pd.notna(values)
+
+
+def first_occurrences(hashes):
+    """
+    Mask of the positions whose key does not occur at an earlier position.
+    """
+    import numpy as np
+
+    _, first = np.unique(hashes, return_index=True)
+    mask = np.zeros(hashes.shape[0], dtype=bool)
+    mask[first] = True
+    return mask
+
+
+class KeySet:
+    """
+    Set of key hashes stored as sorted runs of distinct hashes, e.g. memory mapped runs of earlier files. Keys added
+    to the set are merged into a single run of their own.
+    """
+
+    def __init__(self, runs=()):
+        import numpy as np
+
+        self.runs = [run for run in runs if run.shape[0]]
+        self.added = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return sum(run.shape[0] for run in self.runs) + self.added.shape[0]
+
+    def contains(self, hashes):
+        """
+        Mask of the hashes contained in the set.
+        """
+        import numpy as np
+
+        found = np.zeros(hashes.shape[0], dtype=bool)
+        for run in self.runs + [self.added]:
+            if run.shape[0]:
+                pos = np.minimum(np.searchsorted(run, hashes), run.shape[0] - 1)
+                found |= run[pos] == hashes
+        return found
+
+    def add(self, hashes):
+        import numpy as np
+
+        self.added = np.union1d(self.added, hashes)
+
+
+class KeyRuns:
+    """
+    Sorted runs of the distinct keys of every source file in key_dir.
+    """
+
+    def __init__(self, key_dir):
+        self.key_dir = key_dir
+
+    def path(self, source):
+        import os
+
+        return os.path.join(self.key_dir, source + ".npy")
+
+    def exists(self, source):
+        import os
+
+        return os.path.exists(self.path(source))
+
+    def load(self, source):
+        import numpy as np
+
+        return np.load(self.path(source), mmap_mode="r")
+
+    def write(self, source, hashes):
+        """
+        Store the distinct hashes of a source, replacing its previous run.
+        """
+        import os
+        import numpy as np
+
+        os.makedirs(self.key_dir, exist_ok=True)
+        tmp_path = self.path(source) + ".tmp.npy"
+        np.save(tmp_path, np.unique(np.asarray(hashes, dtype=np.uint64)))
+        os.replace(tmp_path, self.path(source))
+
+    def key_set(self, sources):
+        """
+        KeySet of the keys of the given sources, memory mapped.
+        """
+        return KeySet([self.load(source) for source in sources if self.exists(source)])
+
+    def overlaps(self, source, others):
+        """
+        Those of the sources in others sharing keys with source.
+        """
+        if not self.exists(source):
+            return []
+        run = self.load(source)
+        return [other for other in others if other != source and self.exists(other) and
+                KeySet([self.load(other)]).contains(run).any()]
+
+
+def read_ride_keys(file, chunksize=500000):
+    """
+    Hashes of the ride ids of all trips of a trip file (csv file or zip archive), reading only the ride id column.
+    """
+    import numpy as np
+
+    from preprocessing.citibikeIngest import iter_citibike_chunks
+
+    hashes = [np.empty(0, dtype=np.uint64)]
+    for chunk in iter_citibike_chunks([file], chunksize=chunksize, usecols=[RIDE_KEY]):
+        if RIDE_KEY in chunk.columns:
+            chunk_hashes, present = hash_keys(chunk[RIDE_KEY])
+            hashes.append(np.unique(chunk_hashes[present]))
+    return np.unique(np.concatenate(hashes))
+
+
+def drop_duplicate_trips(chunk, seen):
+    """
+    Drop the trips of a chunk whose ride id is in the KeySet seen (of earlier files and earlier chunks of the same
+    file) or occurs earlier in the chunk, and add the remaining ride ids to seen. Trips without ride id are kept.
+    Returns the deduplicated chunk and the number of trips dropped.
+    """
+    if RIDE_KEY not in chunk.columns:
+        return chunk, 0
+
+    hashes, present = hash_keys(chunk[RIDE_KEY])
+    keep = ~present | (first_occurrences(hashes) & ~seen.contains(hashes))
+    seen.add(hashes[keep & present])
+
+    n_dropped = int((~keep).sum())
+    return (chunk[keep] if n_dropped else chunk), n_dropped
+
+
+def drop_duplicate_keys(df, column):
+    """
+    Keep the first row of every key of a column, e.g. the collision id of the bike accidents. Only the column is
+    compared, by its hashes, instead of the full rows. Rows with a missing key are kept.
+    """
+    hashes, present = hash_keys(df[column])
+    keep = ~present | first_occurrences(hashes)
+    return df[keep].reset_index(drop=True)
@@ -1,71 +1,155 @@
-def get_zipcode_borough_info(df):
+def get_zipcode_borough_info(df, boundaries=None):
 
     """Function for filling in zipcode and borough information for citibike trips. It takes in the starting station
     latitude and longitude for a bike trip, computes distance from recorded NY locations using
     their latitude, longitude information and selects the zipcode and borough that has the least distance.
+    If boundaries (a GeoJSON file of zipcode and/or borough areas) is given, the area containing the starting station
+    is used instead.
     """
-    import pandas as pd
     import numpy as np
 
+    from preprocessing.geocoding import load_ny_zipcodes, select_zipcodes_in_bbox, locate_zipcode_borough
+    from preprocessing.geocoding import regularize_borough_names
+
     # Loading zipcode and location (latitude, longitude) information of NY
-    ny = pd.read_csv("NY-zip-code-latitude-and-longitude.csv", delimiter=";", usecols=[0, 1, 3, 4])
+    ny = load_ny_zipcodes()
 
     # Selecting subset of NY locations pertaining to bike accident dataset.
-    minlat, maxlat = np.min(df["start_lat"]), np.max(df["start_lat"])
-    minlon, maxlon = np.min(df["start_lng"]), np.max(df["start_lng"])
+    ny = select_zipcodes_in_bbox(ny, df["start_lat"], df["start_lng"])
 
-    latlonmask = (ny["Longitude"] >= minlon) & (ny["Longitude"] <= maxlon)
-    latlonmask = latlonmask & (ny["Latitude"] >= minlat) & (ny["Latitude"] <= maxlat)
-    ny = ny[latlonmask]
+    print("\nStarted determining zipcode and borough information for all locations.")
+    found, nearest_zip, nearest_borough = locate_zipcode_borough(ny, df["start_lat"], df["start_lng"],
+                                                                 boundaries=boundaries)
+    print("Determined zipcode and borough for {:} locations.".format(np.count_nonzero(found)))
+    print("Finished determining zipcode and borough information for all locations.")
 
-    # Initialize the columns borough and zipcode
-    df["borough"] = np.nan
-    df["zipcode"] = np.nan
+    # Fill in the columns borough and zipcode
+    borough = np.full(found.shape[0], np.nan, dtype=object)
+    zipcode = np.full(found.shape[0], np.nan)
+    borough[found] = nearest_borough
+    zipcode[found] = nearest_zip
+    df["borough"] = borough
+    df["zipcode"] = zipcode
 
-    # get indices of trips missing a zipcode
-    missing_mask = df["zipcode"].isnull().to_numpy()
-    missing_ind = np.nonzero(missing_mask)[0]
+    mask = df["borough"].isna()
+    df = df[~mask]
 
-    borough_col = np.argwhere(df.columns == "borough")[0]
-    zip_col = np.argwhere(df.columns == "zipcode")[0]
+    df["zipcode"] = df["zipcode"].astype(str)
 
-    print("\nStarted determining zipcode and borough information for all locations.")
-    for k in missing_ind:
-        dist = (df.iloc[k]["start_lng"] - ny["Longitude"])**2 + (df.iloc[k]["start_lat"] - ny["Latitude"])**2
-        dist = dist.to_numpy()
+    # Regularizing the names of the five boroughs
+    df["borough"] = regularize_borough_names(df["borough"])
 
-        nearest_ind = np.argmin(dist)
-        nearest_zip = ny.iloc[nearest_ind]["Zip"]
-        nearest_borough = ny.iloc[nearest_ind]["City"]
+    return df
 
-        dist = dist[nearest_ind]
 
-        if np.isfinite(dist):
-            df.iloc[k, zip_col] = nearest_zip
-            df.iloc[k, borough_col] = nearest_borough
+# Columns identifying a geocoded CitiBike station.
+STATION_KEY_COLUMNS = ["station_key", "lat_key", "lng_key"]
 
-        if not (k % 100000):
-            print("Determined zipcode and borough for {:} locations.".format(k))
-    print("Finished determining zipcode and borough information for all locations.")
 
-    mask = df["borough"].isna()
-    df = df[~mask]
+def station_cache_key(boundaries=None):
+    """
+    Key of the inputs the stations are geocoded from: the NY zipcode file and the boundary file, if given.
+    """
+    from preprocessing.geocoding import NY_ZIPCODE_FILEPATH
+    from preprocessing.pipeline import file_fingerprint
 
-    df["zipcode"] = df["zipcode"].astype(str)
+    return file_fingerprint([NY_ZIPCODE_FILEPATH] + ([boundaries] if boundaries is not None else []))
 
-    # Regularizing the names of the five boroughs
-    # "New York" is recorded as Manhattan in the zip code file
-    df["borough"] = df["borough"].str.replace("New York", "MANHATTAN")
 
-    df["borough"] = df["borough"].str.replace("Bronx", "BRONX")
-    df["borough"] = df["borough"].str.replace("Brooklyn", "BROOKLYN")
-    df["borough"] = df["borough"].str.replace("Staten Island", "STATEN ISLAND")
+def load_station_cache(cache_file, boundaries=None):
+    """
+    Load the table of already geocoded CitiBike stations, or an empty table if there is none yet. A table geocoded
+    from another zipcode file or boundary file (see station_cache_key) is discarded.
+    """
+    import os
+    import numpy as np
+    import pandas as pd
 
-    # Everything else appear to be in Queens
-    # Find them by checking for strings that are not in all caps.
-    mask = df["borough"].str.isupper()
-    mask = ~mask
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            header = f.readline().rstrip("\n")
+        if header == "# " + station_cache_key(boundaries):
+            return pd.read_csv(cache_file, skiprows=1, dtype={"station_key": str, "zipcode": str, "borough": str},
+                               keep_default_na=False)
+        print("\nDiscarding the station cache {:}, it was geocoded from other zipcodes or boundaries.".format(
+            cache_file))
 
-    df.loc[mask, "borough"] = "QUEENS"
+    return pd.DataFrame({"station_key": pd.Series(dtype=str),
+                         "lat_key": pd.Series(dtype=np.int64), "lng_key": pd.Series(dtype=np.int64),
+                         "zipcode": pd.Series(dtype=str), "borough": pd.Series(dtype=str)})
 
-    return df
+
+def save_station_cache(stations, cache_file, boundaries=None):
+    """
+    Store the table of geocoded CitiBike stations, headed by the key of the inputs they were geocoded from.
+    """
+    import os
+
+    if cache_file is not None:
+        if os.path.dirname(cache_file):
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w", newline="") as f:
+            f.write("# " + station_cache_key(boundaries) + "\n")
+            stations.to_csv(f, index=False)
+
+
+def assign_station_zipcode_borough(df, stations, station_col="start_station_id", boundaries=None):
+    """
+    Fill in zipcode and borough of citibike trips from the table of geocoded stations, geocoding the stations that
+    are not in the table yet (by the areas of the boundary file, if given). Returns the trips and the extended table of
+    stations.
+    """
+    import numpy as np
+    import pandas as pd
+
+    from preprocessing.geocoding import load_ny_zipcodes, select_zipcodes_in_bbox, locate_zipcode_borough
+    from preprocessing.geocoding import regularize_borough_names, NYC_LAT_RANGE, NYC_LON_RANGE
+
+    key_cols = STATION_KEY_COLUMNS
+
+    # Trips without a starting position cannot be geocoded.
+    df = df[df["start_lat"].notna() & df["start_lng"].notna()]
+
+    # Build the station keys of all trips.
+    if station_col in df.columns:
+        station_key = df[station_col].astype(str)
+    else:
+        station_key = pd.Series("", index=df.index)
+    keys = pd.DataFrame({"station_key": station_key,
+                         "lat_key": np.round(df["start_lat"].to_numpy() * 1e4).astype(np.int64),
+                         "lng_key": np.round(df["start_lng"].to_numpy() * 1e4).astype(np.int64)},
+                        index=df.index)
+
+    # A station is geocoded at the position of its first trip.
+    first_seen = ~keys.duplicated().to_numpy()
+    unique_keys = keys[first_seen].assign(start_lat=df["start_lat"].to_numpy()[first_seen],
+                                          start_lng=df["start_lng"].to_numpy()[first_seen])
+    new_keys = unique_keys.merge(stations[key_cols], on=key_cols, how="left", indicator=True)
+    new_keys = new_keys.loc[new_keys["_merge"] == "left_only", key_cols + ["start_lat", "start_lng"]]
+    new_keys = new_keys.reset_index(drop=True)
+
+    if new_keys.shape[0]:
+        print("\nDetermining zipcode and borough for {:} new of {:} stations.".format(new_keys.shape[0],
+                                                                                     unique_keys.shape[0]))
+        ny = load_ny_zipcodes()
+        ny = select_zipcodes_in_bbox(ny, NYC_LAT_RANGE, NYC_LON_RANGE)
+
+        found, nearest_zip, nearest_borough = locate_zipcode_borough(ny, new_keys.pop("start_lat"),
+                                                                     new_keys.pop("start_lng"), boundaries=boundaries)
+
+        # Stations without a nearest zipcode are cached with empty zipcode and borough.
+        zipcode = np.full(found.shape[0], np.nan)
+        zipcode[found] = nearest_zip
+        new_keys["zipcode"] = np.where(found, zipcode.astype(str), "")
+        new_keys["borough"] = ""
+        new_keys.loc[found, "borough"] = regularize_borough_names(pd.Series(nearest_borough)).to_numpy()
+
+        stations = pd.concat([stations, new_keys], ignore_index=True)
+
+    # Broadcast the station results back onto the trips.
+    keys = keys.join(stations.set_index(key_cols), on=key_cols)
+
+    df = df.assign(borough=keys["borough"].to_numpy(), zipcode=keys["zipcode"].to_numpy())
+    df = df[df["borough"] != ""]
+
+    return df, stations
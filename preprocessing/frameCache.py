@@ -0,0 +1,89 @@
+"""
+Columnar storage of preprocessed DataFrames, and a hash of the preprocessing code.
+
+Frames are written and read as Parquet if an engine is installed and as pickle otherwise. content_hash identifies the
+version of the preprocessing code, so that results stored by earlier runs are rebuilt once the code changes.
+"""
+
+
+def content_hash(paths):
+    """
+    Compute a hash over the contents of the given files and of the preprocessing scripts.
+    """
+    import os
+    import glob
+    import hashlib
+
+    code_files = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py")))
+
+    digest = hashlib.sha1()
+    for path in list(paths) + code_files:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def parquet_available():
+    """
+    Check whether a Parquet engine (pyarrow or fastparquet) is installed.
+    """
+    import importlib.util
+
+    return any(importlib.util.find_spec(engine) is not None for engine in ("pyarrow", "fastparquet"))
+
+
+def frame_path(path):
+    """
+    File name for storing a DataFrame under path (without extension): Parquet if an engine is installed, else pickle.
+    """
+    return path + (".parquet" if parquet_available() else ".pkl")
+
+
+def write_frame(df, path):
+    """
+    Store a DataFrame in the format given by the extension of path.
+    """
+    import os
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_pickle(path)
+
+
+def read_frame(path, columns=None):
+    """
+    Read a DataFrame stored by write_frame, only the given columns for Parquet files.
+    """
+    import pandas as pd
+
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+
+    df = pd.read_pickle(path)
+    return df if columns is None else df[columns]
+
+
+def read_frames(paths, columns=None):
+    """
+    Read and concatenate DataFrames stored by write_frame. Parquet files are read in a single scan with pyarrow if
+    it is installed, which avoids the overhead of opening every file separately.
+    """
+    import importlib.util
+    import pandas as pd
+
+    paths = list(paths)
+    if paths and all(path.endswith(".parquet") for path in paths) and importlib.util.find_spec("pyarrow") is not None:
+        import pyarrow.dataset
+
+        return pyarrow.dataset.dataset(paths, format="parquet").to_table(columns=columns).to_pandas()
+
+    frames = [read_frame(path, columns=columns) for path in paths]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
@@ -0,0 +1,351 @@
+"""
+Shared geocoding helpers for assigning the nearest NY zipcode and borough to (latitude, longitude) positions.
+
+The NY zipcode table is converted once into a binary table of plain arrays (see ZipcodeTable), which every geocoding
+call and worker process memory maps instead of parsing the csv file again, and a grid based spatial index is built over
+it. Positions are then looked up for whole coordinate arrays at once instead of scanning the full zipcode table for every
+row. Optionally, the zipcode and borough areas of a boundary file are used instead of the nearest zipcode (see boundaries.py).
+"""
+
+
+NY_ZIPCODE_FILEPATH = "NY-zip-code-latitude-and-longitude.csv"
+
+# Fixed (latitude, longitude) ranges covering the five boroughs and the CitiBike service area.
+NYC_LAT_RANGE = (40.45, 40.95)
+NYC_LON_RANGE = (-74.30, -73.65)
+
+
+class ZipcodeTable:
+    """
+    Zipcode, city (borough) and location (latitude, longitude) of the NY zipcodes as plain arrays. The cities are
+    stored as codes into the list of city names, so that all arrays have fixed width and can be memory mapped.
+    """
+
+    def __init__(self, zipcode, city_code, cities, latitude, longitude):
+        self.zipcode = zipcode
+        self.city_code = city_code
+        self.cities = cities
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __len__(self):
+        return self.zipcode.shape[0]
+
+    def select(self, mask):
+        """
+        Subset of the zipcodes selected by a boolean mask or an index array.
+        """
+        return ZipcodeTable(self.zipcode[mask], self.city_code[mask], self.cities, self.latitude[mask],
+                            self.longitude[mask])
+
+    def city(self, ind):
+        """
+        City names of the zipcodes at the positions ind.
+        """
+        import numpy as np
+
+        return np.asarray(self.cities, dtype=object)[self.city_code[ind]]
+
+
+# Arrays of the binary zipcode table.
+ZIPCODE_TABLE_ARRAYS = ["zipcode", "city_code", "latitude", "longitude"]
+
+_zipcode_tables = {}
+
+
+def zipcode_table_dir(filepath):
+    """
+    Folder of the binary zipcode table built from the zipcode csv file filepath.
+    """
+    import os
+
+    return os.path.splitext(filepath)[0] + ".table"
+
+
+def build_zipcode_table(filepath, table_dir):
+    """
+    Convert the NY zipcode csv file into a binary table: one .npy file per array and the city names in a json file
+    together with the size and modification time of the csv file it was built from. The table is written to a
+    temporary folder first and then moved into place, so concurrent builds by several processes are safe.
+    """
+    import os
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    ny = pd.read_csv(filepath, delimiter=";", usecols=[0, 1, 3, 4])
+    city_code, cities = pd.factorize(ny["City"])
+    arrays = {"zipcode": ny["Zip"].to_numpy(dtype=np.int64), "city_code": city_code.astype(np.int32),
+              "latitude": ny["Latitude"].to_numpy(dtype=np.float64),
+              "longitude": ny["Longitude"].to_numpy(dtype=np.float64)}
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(table_dir) + ".", dir=os.path.dirname(table_dir) or ".")
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), array)
+    with open(os.path.join(tmp_dir, "table.json"), "w") as f:
+        json.dump({"source": source_stamp(filepath), "cities": [str(city) for city in cities]}, f)
+
+    shutil.rmtree(table_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, table_dir)
+    except OSError:
+        # Another process moved its table into place first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def source_stamp(filepath):
+    """
+    Size and modification time of a file, for detecting changes without reading it.
+    """
+    import os
+
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_ny_zipcodes(filepath=NY_ZIPCODE_FILEPATH):
+    """
+    Load the zipcode, city (borough) and location (latitude, longitude) information of NY as a ZipcodeTable.
+    The binary table is built from the csv file on first use (and whenever the csv file changes) and is memory
+    mapped, so loading it is nearly free and all processes share the same pages.
+    """
+    import os
+    import json
+    import numpy as np
+
+    table_dir = zipcode_table_dir(filepath)
+    stamp = source_stamp(filepath)
+
+    key = os.path.abspath(filepath)
+    if key in _zipcode_tables and _zipcode_tables[key][0] == stamp:
+        return _zipcode_tables[key][1]
+
+    try:
+        with open(os.path.join(table_dir, "table.json")) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        info = {}
+    if info.get("source") != stamp:
+        build_zipcode_table(filepath, table_dir)
+        with open(os.path.join(table_dir, "table.json")) as f:
+            info = json.load(f)
+
+    arrays = {name: np.load(os.path.join(table_dir, name + ".npy"), mmap_mode="r") for name in ZIPCODE_TABLE_ARRAYS}
+    table = ZipcodeTable(cities=info["cities"], **arrays)
+    _zipcode_tables[key] = (stamp, table)
+
+    return table
+
+
+def select_zipcodes_in_bbox(ny, lat, lon):
+    """
+    Select the subset of NY zipcodes lying inside the bounding box spanned by the given positions. Without any
+    position with known coordinates, the subset is empty.
+    """
+    import numpy as np
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat, lon = lat[np.isfinite(lat)], lon[np.isfinite(lon)]
+    if lat.shape[0] == 0 or lon.shape[0] == 0:
+        return ny.select(np.empty(0, dtype=np.int64))
+
+    minlat, maxlat = lat.min(), lat.max()
+    minlon, maxlon = lon.min(), lon.max()
+
+    latlonmask = (ny.longitude >= minlon) & (ny.longitude <= maxlon)
+    latlonmask = latlonmask & (ny.latitude >= minlat) & (ny.latitude <= maxlat)
+    return ny.select(np.flatnonzero(latlonmask))
+
+
+class GridIndex:
+    """
+    Exact nearest neighbour index over a set of reference points using grid buckets.
+
+    The plane covering the reference points is split into square cells. For every cell we precompute the small set
+    of reference points that can be the nearest neighbour of any position inside that cell, so a query only has to
+    compare against those candidates. Distances are squared euclidean distances in (longitude, latitude) space and
+    ties are resolved in favour of the reference point that comes first, exactly like np.argmin over the full table.
+    """
+
+    def __init__(self, lat, lon, cells_per_point=4, block=256):
+        import numpy as np
+
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        n_points = self.lat.shape[0]
+
+        # Candidates of all cells are stored back to back, those of cell c are indices[offsets[c]:offsets[c + 1]].
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.indices = np.empty(0, dtype=np.int64)
+        if n_points == 0:
+            return
+
+        self.minlat, self.maxlat = self.lat.min(), self.lat.max()
+        self.minlon, self.maxlon = self.lon.min(), self.lon.max()
+
+        # Choose the grid resolution from the number of reference points.
+        n_cells = max(1, n_points * cells_per_point)
+        span_lat = max(self.maxlat - self.minlat, 1e-9)
+        span_lon = max(self.maxlon - self.minlon, 1e-9)
+        self.cellsize = np.sqrt(span_lat * span_lon / n_cells)
+        self.nlat = int(np.ceil(span_lat / self.cellsize)) + 1
+        self.nlon = int(np.ceil(span_lon / self.cellsize)) + 1
+
+        # Lower bounds of every cell.
+        cell_lat0 = self.minlat + self.cellsize * np.arange(self.nlat)
+        cell_lon0 = self.minlon + self.cellsize * np.arange(self.nlon)
+        cell_lat0, cell_lon0 = np.meshgrid(cell_lat0, cell_lon0, indexing="ij")
+        cell_lat0, cell_lon0 = cell_lat0.ravel(), cell_lon0.ravel()
+
+        counts, indices = [], []
+        for start in range(0, cell_lat0.shape[0], block):
+            lat0 = cell_lat0[start:start + block, None]
+            lon0 = cell_lon0[start:start + block, None]
+            lat1, lon1 = lat0 + self.cellsize, lon0 + self.cellsize
+
+            # For every (cell, reference point) pair the smallest and largest possible distance between them.
+            dlat_min = np.maximum(0, np.maximum(lat0 - self.lat, self.lat - lat1))
+            dlon_min = np.maximum(0, np.maximum(lon0 - self.lon, self.lon - lon1))
+            dist_min = dlon_min**2 + dlat_min**2
+
+            dlat_max = np.maximum(np.abs(lat0 - self.lat), np.abs(lat1 - self.lat))
+            dlon_max = np.maximum(np.abs(lon0 - self.lon), np.abs(lon1 - self.lon))
+            dist_max = dlon_max**2 + dlat_max**2
+
+            # Any position in a cell is at most dist_max away from its best reference point, so reference points
+            # whose smallest distance to the cell exceeds that bound can never be the nearest one.
+            bound = dist_max.min(axis=1, keepdims=True)
+            is_candidate = dist_min <= bound * (1 + 1e-9) + 1e-15
+
+            # np.nonzero walks row by row, so the candidates of each cell keep the original order.
+            counts.append(is_candidate.sum(axis=1))
+            indices.append(np.nonzero(is_candidate)[1])
+
+        self.offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+        self.indices = np.concatenate(indices)
+
+    def query(self, lat, lon):
+        """
+        Find the nearest reference point for every position. Returns the index of the nearest reference point and
+        the squared distance to it. Positions without a finite distance (e.g. missing coordinates) get index -1 and
+        distance NaN.
+        """
+        import numpy as np
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        ind = np.full(lat.shape[0], -1, dtype=np.int64)
+        dist = np.full(lat.shape[0], np.nan)
+
+        if self.indices.shape[0] == 0:
+            return ind, dist
+
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        row_lat = np.floor((lat - self.minlat) / self.cellsize)
+        row_lon = np.floor((lon - self.minlon) / self.cellsize)
+        inside = valid & (row_lat >= 0) & (row_lat < self.nlat) & (row_lon >= 0) & (row_lon < self.nlon)
+
+        # Positions inside the grid are grouped by cell and compared only with the candidates of their cell.
+        pos = np.nonzero(inside)[0]
+        cell = row_lat[pos].astype(np.int64) * self.nlon + row_lon[pos].astype(np.int64)
+        order = np.argsort(cell, kind="stable")
+        pos, cell = pos[order], cell[order]
+        bounds = np.flatnonzero(np.diff(cell)) + 1
+        for group in np.split(np.arange(pos.shape[0]), bounds):
+            if not group.shape[0]:
+                continue
+            c = cell[group[0]]
+            cand = self.indices[self.offsets[c]:self.offsets[c + 1]]
+            p = pos[group]
+            ind[p], dist[p] = self._nearest(lat[p], lon[p], cand)
+
+        # Positions outside the grid are rare, these are compared with all reference points.
+        pos = np.nonzero(valid & ~inside)[0]
+        for start in range(0, pos.shape[0], 10000):
+            p = pos[start:start + 10000]
+            ind[p], dist[p] = self._nearest(lat[p], lon[p], np.arange(self.lat.shape[0]))
+
+        # Mirror the original behaviour of only accepting finite distances.
+        notfinite = ~np.isfinite(dist)
+        ind[notfinite] = -1
+        dist[notfinite] = np.nan
+
+        return ind, dist
+
+    def _nearest(self, lat, lon, cand):
+        import numpy as np
+
+        d = (lon[:, None] - self.lon[cand])**2 + (lat[:, None] - self.lat[cand])**2
+        best = np.argmin(d, axis=1)
+        return cand[best], d[np.arange(lat.shape[0]), best]
+
+
+def nearest_zipcode_borough(ny, lat, lon):
+    """
+    Determine the nearest zipcode and city (borough) from the NY zipcode table for every position.
+    Returns the boolean array found, marking the positions for which a nearest zipcode exists, together with the
+    zipcodes and cities of those positions.
+    """
+    index = GridIndex(ny.latitude, ny.longitude)
+    nearest_ind, _ = index.query(lat, lon)
+
+    found = nearest_ind >= 0
+    nearest_zip = ny.zipcode[nearest_ind[found]]
+    nearest_borough = ny.city(nearest_ind[found])
+
+    return found, nearest_zip, nearest_borough
+
+
+def locate_zipcode_borough(ny, lat, lon, boundaries=None):
+    """
+    Determine zipcode and city (borough) for every position, like nearest_zipcode_borough. If a boundary file
+    (GeoJSON of zipcode and/or borough areas) is given, they are taken from the area containing the position instead,
+    and only positions outside all areas, or whose area lacks a zipcode or borough, fall back to the nearest zipcode.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if boundaries is None:
+        return nearest_zipcode_borough(ny, lat, lon)
+
+    from preprocessing.boundaries import load_boundaries
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    zipcode, borough = load_boundaries(boundaries).locate(lat, lon)
+
+    missing = np.flatnonzero((zipcode < 0) | pd.isna(borough))
+    if missing.shape[0]:
+        found, nearest_zip, nearest_borough = nearest_zipcode_borough(ny, lat[missing], lon[missing])
+        fill = missing[found]
+        zipcode[fill] = np.where(zipcode[fill] < 0, nearest_zip, zipcode[fill])
+        borough[fill] = np.where(pd.isna(borough[fill]), nearest_borough, borough[fill])
+
+    found = (zipcode >= 0) & pd.notna(borough)
+    return found, zipcode[found], borough[found]
+
+
+def regularize_borough_names(borough):
+    """
+    Regularize the city names of the zipcode file into the names of the five boroughs.
+    """
+    # "New York" is recorded as Manhattan in the zip code file
+    borough = borough.str.replace("New York", "MANHATTAN")
+
+    borough = borough.str.replace("Bronx", "BRONX")
+    borough = borough.str.replace("Brooklyn", "BROOKLYN")
+    borough = borough.str.replace("Staten Island", "STATEN ISLAND")
+
+    # Everything else appear to be in Queens
+    # Find them by checking for strings that are not in all caps.
+    mask = borough.str.isupper()
+    mask = ~mask
+
+    borough = borough.copy()
+    borough[mask] = "QUEENS"
+
+    return borough
@@ -0,0 +1,92 @@
+"""
+Lightweight per-stage instrumentation of the analysis pipeline.
+
+Every stage records its wall time, the number of rows going in and out, the throughput in rows per second and the
+peak resident memory (RSS) of the process at the end of the stage. The records are printed as a summary and written
+to a json file.
+"""
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the current process in MB, or None where the resource module is not available.
+    """
+    import sys
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KB elsewhere.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class StageProfiler:
+    """
+    Collects timing and memory records of the pipeline stages. When disabled, stages are run without recording.
+
+    Usage:
+        with profiler.stage("clean", rows_in=df.shape[0]) as record:
+            df = clean_data(df)
+            record["rows_out"] = df.shape[0]
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.depth = 0
+
+    def stage(self, name, rows_in=None):
+        import time
+        from contextlib import contextmanager
+
+        @contextmanager
+        def run_stage():
+            record = {"stage": name, "depth": self.depth, "rows_in": rows_in, "rows_out": None}
+            if not self.enabled:
+                yield record
+                return
+
+            self.records.append(record)
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                yield record
+            finally:
+                self.depth -= 1
+                record["seconds"] = time.perf_counter() - start
+                for key in ["rows_in", "rows_out"]:
+                    if record[key] is not None:
+                        record[key] = int(record[key])
+                rows = record["rows_in"] if record["rows_in"] is not None else record["rows_out"]
+                record["rows_per_second"] = rows / record["seconds"] if rows and record["seconds"] > 0 else None
+                record["peak_rss_mb"] = peak_rss_mb()
+
+        return run_stage()
+
+    def summary(self):
+        """
+        Format the stage records as a table.
+        """
+        def fmt(value, spec):
+            return format(value, spec) if value is not None else "-"
+
+        lines = ["{:<32} {:>10} {:>12} {:>12} {:>14} {:>12}".format("Stage", "Seconds", "Rows in", "Rows out",
+                                                                     "Rows/second", "Peak RSS MB")]
+        for record in self.records:
+            lines.append("{:<32} {:>10} {:>12} {:>12} {:>14} {:>12}".format(
+                "  " * record["depth"] + record["stage"], fmt(record["seconds"], ".3f"), fmt(record["rows_in"], "d"),
+                fmt(record["rows_out"], "d"), fmt(record["rows_per_second"], ",.0f"),
+                fmt(record["peak_rss_mb"], ".1f")))
+        return "\n".join(lines)
+
+    def write(self, output_file):
+        """
+        Write the stage records to a json file.
+        """
+        import json
+
+        with open(output_file, "w") as f:
+            json.dump({"stages": self.records}, f, indent=2)
@@ -1,5 +1,9 @@
 def correct_vehicle_names(df):
-
+    """
+    Function for regularizing the vehicle names in the VEHICLE TYPE CODE columns. All vehicle columns are
+    normalized in a single pass over their unique values and written back as categoricals sharing the same
+    categories, so that the same vehicle has the same code in every column.
+    """
     import pandas as pd
     import numpy as np
 
@@ -7,35 +11,66 @@ def correct_vehicle_names(df):
     col_id = df.columns.str.match("vehicle type")
     cols = df.columns[col_id].tolist()
 
-    # Convert to lowercase and remove whitespaces both leading and trailing
-    for col in cols:
-        df[col] = df[col].str.lower()
-        df[col] = df[col].str.strip()
+    # Encode every column as codes into its unique values.
+    codes, uniques = zip(*[pd.factorize(df[col]) for col in cols])
 
-    # Perform vehicle name correction
+    # Correct the names of all unique values once: convert to lowercase, remove whitespaces both leading and
+    # trailing, and perform vehicle name correction.
     vehiclename_dict = vehiclename_corrector()
+    corrected = [np.array([correct_vehicle_name(value, vehiclename_dict) for value in values], dtype=object)
+                 for values in uniques]
 
-    for col in cols:
-        for old, new in vehiclename_dict.items():
-            df[col] = df[col].replace(old, new, regex=False)
+    # Collect the corrected names of all columns into one set of categories, with "other" for rare names.
+    categories = pd.Index(np.concatenate(corrected + [np.array(["other"], dtype=object)])).dropna().unique()
+    codes = [recode(col_codes, categories.get_indexer(col_corrected))
+             for col_codes, col_corrected in zip(codes, corrected)]
 
     # Replace all instances with less than 5 incidents in column "vehicle type code 1" and
     # all instances with less than 3 incidents in column "vehicle type code 2" with "other".
-    target_idgroup1 = df["vehicle type code 1"].value_counts()
-    target_idgroup1 = target_idgroup1[target_idgroup1 < 5]
-
-    target_idgroup2 = df["vehicle type code 2"].value_counts()
-    target_idgroup2 = target_idgroup2[target_idgroup2 < 3]
+    counts1 = np.bincount(codes[cols.index("vehicle type code 1")] + 1, minlength=categories.shape[0] + 1)[1:]
+    counts2 = np.bincount(codes[cols.index("vehicle type code 2")] + 1, minlength=categories.shape[0] + 1)[1:]
+    target_ids = ((counts1 > 0) & (counts1 < 5)) | ((counts2 > 0) & (counts2 < 3))
+    target_ids[categories.get_loc("other")] = False
 
-    target_ids = pd.concat([target_idgroup1, target_idgroup2]).index
+    kept = categories[~target_ids]
+    collapse = kept.get_indexer(categories)
+    collapse[target_ids] = kept.get_loc("other")
 
-    for col in cols:
-        mask = df[col].isin(target_ids)
-        df.loc[mask, col] = "other"
+    for col, col_codes in zip(cols, codes):
+        df[col] = pd.Categorical.from_codes(recode(col_codes, collapse), categories=kept)
 
     return df
 
 
+def correct_vehicle_name(value, vehiclename_dict):
+    """
+    Regularize a single vehicle name the same way for all columns.
+    """
+    import numpy as np
+
+    if not isinstance(value, str):
+        return np.nan
+
+    value = value.lower().strip()
+
+    # The corrections are applied one after another, as a corrected name could be corrected again.
+    for old, new in vehiclename_dict.items():
+        if value == old:
+            value = new
+
+    return value
+
+
+def recode(codes, mapping):
+    """
+    Map codes through mapping, keeping missing values (code -1) as missing.
+    """
+    import numpy as np
+
+    # Missing codes index the first entry, as mapping is empty for a column without any values.
+    return np.where(codes >= 0, mapping[np.maximum(codes, 0)] if mapping.shape[0] else -1, -1)
+
+
 def vehiclename_corrector():
     vehiclename_lookup = {
 
@@ -0,0 +1,120 @@
+"""
+Minimal stage-based pipeline runner.
+
+Every stage declares its input files, the stages it depends on, the parameters it uses and the files it writes.
+A stage is skipped when its outputs exist and neither its inputs, its parameters nor any of the stages it depends on
+changed since it last ran, which is tracked in a json manifest.
+"""
+
+
+class Stage:
+    """
+    A named step of the pipeline. run() is called without arguments and has to write all files in outputs.
+    """
+
+    def __init__(self, name, run, inputs=(), depends=(), outputs=(), params=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.depends = list(depends)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+
+def file_fingerprint(paths):
+    """
+    Cheap fingerprint of files from their names, sizes and modification times, without reading their contents.
+    """
+    import os
+    import hashlib
+
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update("{:}:{:}:{:}\n".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+
+    return digest.hexdigest()
+
+
+def stage_key(stage, dependency_keys, code_files):
+    """
+    Key identifying the inputs of a stage: its input files, parameters, the code and the keys of the stages it
+    depends on.
+    """
+    import json
+    import hashlib
+
+    digest = hashlib.sha1()
+    digest.update(file_fingerprint(stage.inputs + code_files).encode())
+    digest.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    for name in stage.depends:
+        digest.update("{:}={:}".format(name, dependency_keys[name]).encode())
+
+    return digest.hexdigest()
+
+
+def run_pipeline(stages, targets=None, manifest_file="pipeline-manifest.json", force=False, profiler=None,
+                 code_files=()):
+    """
+    Run the stages needed for the target stages (all stages by default) in order. Stages that are up to date are
+    skipped, except for stages explicitly given as targets. With force=True every needed stage is run.
+    """
+    import os
+    import glob
+    import json
+
+    from preprocessing.instrumentation import StageProfiler
+
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+
+    stages = {stage.name: stage for stage in stages}
+    explicit = set(targets or [])
+    if targets is None:
+        targets = list(stages)
+
+    for name in targets:
+        if name not in stages:
+            raise ValueError("Unknown stage {:}, available stages are: {:}".format(name, ", ".join(stages)))
+
+    # Collect the target stages and the stages they depend on, dependencies first.
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for dependency in stages[name].depends:
+            visit(dependency)
+        order.append(name)
+
+    for name in targets:
+        visit(name)
+
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # The code of the pipeline is part of every stage's inputs.
+    code_files = list(code_files) + sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py")))
+
+    keys = {}
+    for name in order:
+        stage = stages[name]
+        keys[name] = stage_key(stage, keys, code_files)
+
+        up_to_date = manifest.get(name) == keys[name] and all(os.path.exists(path) for path in stage.outputs)
+        if up_to_date and not force and name not in explicit:
+            print("\nStage {:} is up to date, skipping it.".format(name))
+            continue
+
+        print("\nRunning stage {:}.".format(name))
+        with profiler.stage(name):
+            stage.run()
+
+        manifest[name] = keys[name]
+        manifest_dir = os.path.dirname(manifest_file)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
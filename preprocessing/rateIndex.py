@@ -0,0 +1,204 @@
+"""
+Precomputed index of the bike accidents, cyclists injured and killed and CitiBike rentals per zipcode and borough,
+for answering rate queries without touching the raw data or the rollups.
+
+The index is built from the monthly rollups (see rollups.py) and stored in a folder of plain arrays, which are memory
+mapped when it is loaded. For every zipcode and borough, the months are sorted and the values are kept as running
+sums, so the totals over any range of months are the difference of two running sums found by binary search:
+    <index_dir>/index.json              borough names, populations and the period covered
+    <index_dir>/<table>_<array>.npy     keys, offsets, months and running sums of the tables zipcode, borough, total
+"""
+
+
+# Values of the index.
+INDEX_VALUES = ["rentals", "accidents", "cyclists_injured", "cyclists_killed"]
+
+# Tables of the index and their key column in the rollups.
+INDEX_TABLES = {"zipcode": "zipcode", "borough": "borough", "total": None}
+
+
+def month_number(month):
+    """
+    Months since January 1970 of a month given as "YYYY-MM".
+    """
+    year, month = str(month).split("-")[:2]
+    return (int(year) - 1970) * 12 + int(month) - 1
+
+
+def build_table(rollup, keys):
+    """
+    Arrays of a table of the index from a rollup with the columns month, the values and the integer key column keys
+    (None for the table of the totals).
+    """
+    import numpy as np
+
+    months = rollup["month"].map(month_number).to_numpy(dtype=np.int32)
+    key = rollup[keys].to_numpy(dtype=np.int64) if keys is not None else np.zeros(rollup.shape[0], dtype=np.int64)
+
+    # Sum duplicate (key, month) pairs and sort by key and month.
+    order = np.lexsort((months, key))
+    key, months = key[order], months[order]
+    first = np.flatnonzero(np.diff(key, prepend=-2) | np.diff(months, prepend=-2))
+    arrays = {"month": months[first]}
+    for col in INDEX_VALUES:
+        sums = np.add.reduceat(rollup[col].to_numpy(dtype=np.int64)[order], first) if first.shape[0] else \
+            np.empty(0, dtype=np.int64)
+        arrays[col] = np.concatenate([[0], np.cumsum(sums)]).astype(np.int64)
+
+    key = key[first]
+    starts = np.flatnonzero(np.diff(key, prepend=key[0] - 1 if key.shape[0] else 0))
+    arrays["keys"] = key[starts]
+    arrays["offsets"] = np.append(starts, key.shape[0]).astype(np.int64)
+    return arrays
+
+
+def month_range(rollup):
+    """
+    First and last month (YYYY-MM) of a rollup indexed by month, [None, None] if it is empty.
+    """
+    if not rollup.shape[0]:
+        return [None, None]
+    months = rollup.index.get_level_values("month").astype(str)
+    return [months.min(), months.max()]
+
+
+def build_rate_index(rollup_dir, index_dir, sources=None, months=None, population=None):
+    """
+    Build the index from the rental and accident rollups in rollup_dir, the rentals of the trip files in sources
+    (all by default) over the months FIRST to LAST (YYYY-MM, all by default), and store it in index_dir. population
+    maps borough names to their population.
+    """
+    import os
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    from preprocessing.boundaries import parse_zipcode
+    from preprocessing.rollups import query_rollups
+
+    rentals = query_rollups(rollup_dir, "rentals", ["month", "borough", "zipcode"], months=months, sources=sources)
+    accidents = query_rollups(rollup_dir, "accidents", ["month", "borough", "zipcode"])
+    rollup = pd.concat([rentals.reset_index(), accidents.reset_index()], ignore_index=True)
+    for col in INDEX_VALUES:
+        rollup[col] = rollup[col].fillna(0).astype("int64") if col in rollup.columns else 0
+
+    # Borough names of the rentals and the accidents differ in case.
+    borough = rollup["borough"].astype(str).str.upper()
+    rollup["borough"], boroughs = pd.factorize(borough, sort=True)
+    rollup["zipcode"] = rollup["zipcode"].map(parse_zipcode)
+
+    info = {"boroughs": list(boroughs),
+            "population": {str(name).upper(): people for name, people in (population or {}).items()},
+            "months": [rollup["month"].min(), rollup["month"].max()] if rollup.shape[0] else [None, None],
+            "rental_months": month_range(rentals), "accident_months": month_range(accidents)}
+
+    # Rates are only meaningful over the months covered by both the accidents and the rentals.
+    first = max(info["rental_months"][0] or "9999-12", info["accident_months"][0] or "9999-12")
+    last = min(info["rental_months"][1] or "0000-01", info["accident_months"][1] or "0000-01")
+    info["rate_months"] = [first, last] if first <= last else None
+
+    parent = os.path.dirname(os.path.abspath(index_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(index_dir) + ".", dir=parent)
+    for table, keys in INDEX_TABLES.items():
+        for name, array in build_table(rollup, keys).items():
+            np.save(os.path.join(tmp_dir, "{:}_{:}.npy".format(table, name)), array)
+    with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+        json.dump(info, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.rename(tmp_dir, index_dir)
+
+
+class RateIndex:
+    """
+    Memory mapped rate index stored by build_rate_index.
+    """
+
+    def __init__(self, index_dir):
+        import os
+        import json
+        import glob
+        import numpy as np
+
+        with open(os.path.join(index_dir, "index.json")) as f:
+            self.info = json.load(f)
+        self.boroughs = {name: code for code, name in enumerate(self.info["boroughs"])}
+
+        self.tables = {table: {} for table in INDEX_TABLES}
+        for path in glob.glob(os.path.join(index_dir, "*.npy")):
+            table, name = os.path.splitext(os.path.basename(path))[0].split("_", 1)
+            self.tables[table][name] = np.load(path, mmap_mode="r")
+
+    def totals(self, table, key, months=None):
+        """
+        Sums of the values of a key of a table (zipcode, borough code or 0 for the totals) over the months FIRST to
+        LAST (YYYY-MM, all months by default, either may be None for an open range).
+        """
+        import numpy as np
+
+        arrays = self.tables[table]
+        i = int(np.searchsorted(arrays["keys"], key))
+        if i == arrays["keys"].shape[0] or arrays["keys"][i] != key:
+            return {col: 0 for col in INDEX_VALUES}
+
+        lo, hi = int(arrays["offsets"][i]), int(arrays["offsets"][i + 1])
+        first, last = months if months is not None else (None, None)
+        month = arrays["month"][lo:hi]
+        start = lo + int(np.searchsorted(month, month_number(first), side="left")) if first is not None else lo
+        stop = lo + int(np.searchsorted(month, month_number(last), side="right")) if last is not None else hi
+        lo, hi = start, max(start, stop)
+        return {col: int(arrays[col][hi] - arrays[col][lo]) for col in INDEX_VALUES}
+
+    def query(self, zipcode=None, borough=None, months=None):
+        """
+        Accidents, cyclists injured and killed and rentals of a zipcode, of a borough, or of all of NYC if neither is
+        given, over the months FIRST to LAST (YYYY-MM). The rates are per 100k rentals, and for boroughs also per 100k
+        of the population.
+
+        By default, the months covered by both the accidents and the rentals (self.info["rate_months"]) are used. If
+        they do not overlap, all months are summed and the rates per rental are NaN.
+        """
+        rates = True
+        if months is None:
+            months = self.info.get("rate_months")
+            rates = months is not None
+
+        if zipcode is not None:
+            result = self.totals("zipcode", int(zipcode), months)
+        elif borough is not None:
+            code = self.boroughs.get(str(borough).upper())
+            result = self.totals("borough", code, months) if code is not None else {col: 0 for col in INDEX_VALUES}
+        else:
+            result = self.totals("total", 0, months)
+
+        rentals = result["rentals"] if rates else 0
+        result["accidents_per_100k_rentals"] = 1e5 * result["accidents"] / rentals if rentals else float("nan")
+        result["injuries_per_100k_rentals"] = 1e5 * result["cyclists_injured"] / rentals if rentals else float("nan")
+        result["deaths_per_100k_rentals"] = 1e5 * result["cyclists_killed"] / rentals if rentals else float("nan")
+
+        population = self.info["population"].get(str(borough).upper()) if borough is not None else None
+        if zipcode is None and population:
+            result["population"] = population
+            result["injuries_per_100k"] = 1e5 * result["cyclists_injured"] / population
+            result["deaths_per_100k"] = 1e5 * result["cyclists_killed"] / population
+
+        return result
+
+
+_loaded_indexes = {}
+
+
+def load_rate_index(index_dir):
+    """
+    Load the index once per process and reuse it for later calls, until the index is rebuilt.
+    """
+    import os
+
+    key = os.path.abspath(index_dir)
+    stamp = os.stat(os.path.join(index_dir, "index.json")).st_mtime_ns
+    if key not in _loaded_indexes or _loaded_indexes[key][0] != stamp:
+        _loaded_indexes[key] = (stamp, RateIndex(index_dir))
+    return _loaded_indexes[key][1]
@@ -0,0 +1,249 @@
+"""
+Out-of-core rollups of the CitiBike rentals and the bike accidents.
+
+Instead of keeping all trips or accidents in memory, every source file is reduced to small partial aggregates per
+month, keyed by borough, zipcode, hour of the week and (for rentals) rideable type. The partials of a source are
+stored as
+    <rollup_dir>/<name>/<source>.parquet
+and are mergeable: any question over a range of months is answered by reading the partials, keeping the rows of those
+months and summing them. When a source file changes, only its own partials are rebuilt.
+
+The hourly rollups (rentals_hourly, accidents_hourly) keep the actual hour instead of the hour of the week, for time
+series of the rentals and accidents per borough (see timeSeries.py).
+"""
+
+
+# Key columns of the rollups.
+RENTAL_KEYS = ["borough", "zipcode", "hour_of_week", "rideable_type"]
+ACCIDENT_KEYS = ["borough", "zipcode", "hour_of_week"]
+HOURLY_KEYS = ["borough", "hour"]
+
+# Value columns of the rollups.
+ROLLUP_VALUES = {"rentals": ["rentals"], "accidents": ["accidents", "cyclists_injured", "cyclists_killed"],
+                 "rentals_hourly": ["rentals"],
+                 "accidents_hourly": ["accidents", "cyclists_injured", "cyclists_killed"]}
+
+# Columns of the CitiBike trip files needed for the rental rollups.
+ROLLUP_TRIP_COLUMNS = ["started_at", "rideable_type", "start_station_id", "start_lat", "start_lng"]
+
+
+def hour_of_week(dt):
+    """
+    Hour of the week (0 = Monday 0:00 to 167 = Sunday 23:00) of a datetime Series.
+    """
+    return (dt.dt.dayofweek * 24 + dt.dt.hour).astype("int16")
+
+
+def merge_rollups(frames, keys):
+    """
+    Combine partial rollups by summing their values over identical keys. Categorical key columns are combined by
+    their categories, so the strings are not compared row by row.
+    """
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+
+    frames = [frame for frame in frames if frame.shape[0]]
+    if not frames:
+        return pd.DataFrame(columns=keys)
+
+    columns = {}
+    for col in frames[0].columns:
+        parts = [frame[col] for frame in frames]
+        if col in keys and all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[col] = pd.Series(union_categoricals(parts, sort_categories=True))
+        elif col in keys:
+            columns[col] = pd.concat(parts, ignore_index=True)
+        else:
+            # Partials store their values as small integers, the sums may need more room.
+            columns[col] = pd.concat(parts, ignore_index=True).astype("int64")
+
+    df = pd.DataFrame(columns).groupby(keys, sort=True, observed=True, dropna=False).sum().reset_index()
+    for col in keys:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+
+def category_mask(values, keep):
+    """
+    Evaluate keep, a function of an Index of values, once per distinct value of a column and look the result up for
+    every row. Missing values are never kept.
+    """
+    import numpy as np
+
+    values = values.astype("category")
+    return np.append(np.asarray(keep(values.cat.categories), dtype=bool), False)[values.cat.codes.to_numpy()]
+
+
+def rollup_trips(trips):
+    """
+    Count the rentals of geocoded CitiBike trips per month, borough, zipcode, hour of the week and rideable type.
+    """
+    import pandas as pd
+
+    started_at = pd.to_datetime(trips["started_at"])
+    rideable_type = trips["rideable_type"] if "rideable_type" in trips.columns else pd.Series("unknown",
+                                                                                              index=trips.index)
+    keys = pd.DataFrame({"month": started_at.to_numpy().astype("datetime64[M]"),
+                         "borough": trips["borough"].astype(str),
+                         "zipcode": trips["zipcode"].astype(str),
+                         "hour_of_week": hour_of_week(started_at),
+                         "rideable_type": rideable_type.astype(str).fillna("unknown")})
+    keys = keys[started_at.notna().to_numpy()]
+
+    rollup = keys.groupby(["month"] + RENTAL_KEYS, sort=True).size().rename("rentals").reset_index()
+    rollup["month"] = rollup["month"].dt.strftime("%Y-%m")
+    return rollup
+
+
+def rollup_accidents(accidents):
+    """
+    Count the bike accidents and the cyclists injured and killed per month, borough, zipcode and hour of the week.
+    """
+    import pandas as pd
+
+    keys = pd.DataFrame({"month": accidents["datetime"].to_numpy().astype("datetime64[M]"),
+                         "borough": accidents["borough"].astype(str),
+                         "zipcode": accidents["zip code"].astype(str),
+                         "hour_of_week": hour_of_week(accidents["datetime"]),
+                         "accidents": 1,
+                         "cyclists_injured": accidents["number of cyclist injured"].fillna(0).astype("int64"),
+                         "cyclists_killed": accidents["number of cyclist killed"].fillna(0).astype("int64")})
+    keys = keys[accidents["datetime"].notna().to_numpy()]
+
+    rollup = keys.groupby(["month"] + ACCIDENT_KEYS, sort=True).sum().reset_index()
+    rollup["month"] = rollup["month"].dt.strftime("%Y-%m")
+    return rollup
+
+
+def rollup_trips_hourly(trips):
+    """
+    Count the rentals of geocoded CitiBike trips per borough and hour.
+    """
+    import pandas as pd
+
+    started_at = pd.to_datetime(trips["started_at"])
+    keys = pd.DataFrame({"month": started_at.to_numpy().astype("datetime64[M]"),
+                         "borough": trips["borough"].astype(str),
+                         "hour": started_at.dt.floor("h")})
+    keys = keys[started_at.notna().to_numpy()]
+
+    rollup = keys.groupby(["month"] + HOURLY_KEYS, sort=True).size().rename("rentals").reset_index()
+    rollup["month"] = rollup["month"].dt.strftime("%Y-%m")
+    return rollup
+
+
+def rollup_accidents_hourly(accidents):
+    """
+    Count the bike accidents and the cyclists injured and killed per borough and hour. Borough names are upper-cased
+    like those of the rentals.
+    """
+    import pandas as pd
+
+    keys = pd.DataFrame({"month": accidents["datetime"].to_numpy().astype("datetime64[M]"),
+                         "borough": accidents["borough"].astype(str).str.upper(),
+                         "hour": accidents["datetime"].dt.floor("h"),
+                         "accidents": 1,
+                         "cyclists_injured": accidents["number of cyclist injured"].fillna(0).astype("int64"),
+                         "cyclists_killed": accidents["number of cyclist killed"].fillna(0).astype("int64")})
+    keys = keys[accidents["datetime"].notna().to_numpy()]
+
+    rollup = keys.groupby(["month"] + HOURLY_KEYS, sort=True).sum().reset_index()
+    rollup["month"] = rollup["month"].dt.strftime("%Y-%m")
+    return rollup
+
+
+def write_rollups(rollup, rollup_dir, name, source):
+    """
+    Store the partials (a rollup with a month column) of the given source, replacing its previous partials.
+    """
+    import os
+
+    from preprocessing.frameCache import frame_path, write_frame
+
+    remove_rollups(rollup_dir, name, source)
+    write_frame(compact_rollup(rollup), frame_path(os.path.join(rollup_dir, name, source)))
+
+
+def remove_rollups(rollup_dir, name, source):
+    """
+    Remove the partials of a source.
+    """
+    import os
+    import glob
+
+    for path in glob.glob(os.path.join(rollup_dir, name, glob.escape(source) + ".*")):
+        os.remove(path)
+
+
+def compact_rollup(rollup):
+    """
+    Store the key columns of a rollup as categoricals and its values as small integers where possible.
+    """
+    import pandas as pd
+
+    rollup = rollup.reset_index(drop=True)
+    for col in rollup.columns:
+        if col == "hour_of_week":
+            rollup[col] = rollup[col].astype("int16")
+        elif col == "hour":
+            continue
+        elif rollup[col].dtype == object:
+            rollup[col] = rollup[col].astype("category")
+        else:
+            rollup[col] = pd.to_numeric(rollup[col], downcast="integer")
+    return rollup
+
+
+def query_rollups(rollup_dir, name, by, months=None, where=None, sources=None):
+    """
+    Sum the values of the rollup over the months FIRST to LAST (YYYY-MM, all months by default), grouped by the key
+    columns in by (e.g. ["zipcode", "hour_of_week"], or ["month"] for monthly totals). where restricts key columns to
+    given values, e.g. {"rideable_type": ["electric_bike"]}, and sources to the partials of the given source files.
+    Returns a DataFrame indexed by the columns in by, or the totals as a Series if by is empty.
+    """
+    import os
+    import glob
+    import numpy as np
+    import pandas as pd
+
+    from preprocessing.frameCache import read_frames
+
+    where = where or {}
+    first, last = months if months is not None else (None, None)
+
+    # Only the columns needed for the question are read.
+    columns = None
+    if name in ROLLUP_VALUES:
+        columns = list(dict.fromkeys(["month"] + list(by) + list(where) + ROLLUP_VALUES[name]))
+
+    paths = []
+    for path in sorted(glob.glob(os.path.join(rollup_dir, name, "*"))):
+        source, extension = os.path.splitext(os.path.basename(path))
+        if extension in (".parquet", ".pkl") and (sources is None or source in sources):
+            paths.append(path)
+    # Without partials, or without rows left, the result still has the value columns.
+    empty = pd.DataFrame({col: pd.Series(dtype="int64") for col in ROLLUP_VALUES.get(name, [])})
+    if not paths:
+        return empty.sum() if not by else empty.reindex(columns=list(by) + list(empty.columns)).set_index(list(by))
+
+    rollup = read_frames(paths, columns=columns)
+    mask = np.ones(rollup.shape[0], dtype=bool)
+    if first is not None:
+        mask &= category_mask(rollup["month"], lambda months: months.astype(str) >= first)
+    if last is not None:
+        mask &= category_mask(rollup["month"], lambda months: months.astype(str) <= last)
+    for col, values in where.items():
+        mask &= category_mask(rollup[col], lambda categories: categories.isin(values))
+
+    if name in ROLLUP_VALUES:
+        keys = [col for col in rollup.columns if col not in ROLLUP_VALUES[name]]
+    else:
+        keys = [col for col in rollup.columns if col == "month" or col in RENTAL_KEYS]
+    rollup = rollup[mask].drop(columns=[col for col in keys if col not in by])
+
+    if not by:
+        return rollup.astype("int64").sum()
+    if not rollup.shape[0]:
+        return empty.reindex(columns=list(by) + list(empty.columns)).set_index(list(by))
+    return merge_rollups([rollup], list(by)).set_index(list(by))
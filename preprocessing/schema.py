@@ -0,0 +1,64 @@
+"""
+Memory-compact column types for the bike accident and CitiBike trip data.
+
+Low-cardinality strings are stored as categoricals, coordinates as float32 and counts as nullable small integers.
+The *_READ_DTYPES are passed to pd.read_csv when loading the raw files. Columns that are still rewritten or used in
+masks during preprocessing (borough, zip code, contributing factors, counts) keep their default types and are only
+compacted by compact_bike_accidents once preprocessing is done.
+"""
+
+
+# Column types used when reading the bike accident dataset.
+ACCIDENT_READ_DTYPES = {
+    "latitude": "float32",
+    "longitude": "float32",
+    "collision id": "int64",
+    "vehicle type code 1": "category",
+    "vehicle type code 2": "category",
+    "vehicle type code 3": "category",
+    "vehicle type code 4": "category",
+    "vehicle type code 5": "category",
+}
+
+# Column types of the preprocessed bike accident dataset.
+ACCIDENT_DTYPES = {
+    "number of persons injured": "Int16",
+    "number of persons killed": "Int16",
+    "number of pedestrians injured": "Int16",
+    "number of pedestrians killed": "Int16",
+    "number of cyclist injured": "Int16",
+    "number of cyclist killed": "Int16",
+    "number of motorist injured": "Int16",
+    "number of motorist killed": "Int16",
+    "borough": "category",
+    "zip code": "category",
+    "contributing factor vehicle 1": "category",
+    "contributing factor vehicle 2": "category",
+    "contributing factor vehicle 3": "category",
+    "contributing factor vehicle 4": "category",
+    "contributing factor vehicle 5": "category",
+    "accident_outcome": "Int8",
+}
+
+# Column types used when reading the CitiBike trip data.
+TRIP_READ_DTYPES = {
+    "ride_id": "string",
+    "rideable_type": "category",
+    "member_casual": "category",
+    "start_station_name": "category",
+    "start_station_id": "category",
+    "end_station_name": "category",
+    "end_station_id": "category",
+    "start_lat": "float32",
+    "start_lng": "float32",
+    "end_lat": "float32",
+    "end_lng": "float32",
+}
+
+
+def compact_bike_accidents(df):
+    """
+    Convert the columns of the preprocessed bike accident dataset to their compact types.
+    """
+    dtypes = {col: dtype for col, dtype in {**ACCIDENT_READ_DTYPES, **ACCIDENT_DTYPES}.items() if col in df.columns}
+    return df.astype(dtypes)
@@ -0,0 +1,208 @@
+"""
+Station level exposure: joining the bike accidents to the CitiBike stations around them and to the trips active
+around the time of the crash.
+
+Stations are bucketed in a grid of square cells as large as the join radius, so an accident is only compared with the
+stations of the 3x3 cells around it. Trip start times are sorted per station, and all start and end times are sorted
+once, so the trips in the time window of a crash are counted by binary search instead of comparing all pairs.
+"""
+
+
+# Columns of the CitiBike trip files needed for the join, the ride ids for deduplicating the trips.
+EXPOSURE_TRIP_COLUMNS = ["ride_id", "started_at", "ended_at", "start_station_id", "start_lat", "start_lng"]
+
+# Meters per degree of latitude, distances are computed on a plane tangent at the latitude of NYC.
+METERS_PER_DEGREE = 111195.0
+NYC_LATITUDE = 40.7
+
+
+def to_meters(lat, lon):
+    """
+    Project (latitude, longitude) onto a plane in meters, which is accurate to well below a percent within NYC.
+    """
+    import numpy as np
+
+    x = np.asarray(lon, dtype=np.float64) * METERS_PER_DEGREE * np.cos(np.radians(NYC_LATITUDE))
+    y = np.asarray(lat, dtype=np.float64) * METERS_PER_DEGREE
+    return x, y
+
+
+class RadiusIndex:
+    """
+    Fixed radius neighbour search over a set of points (the stations) using grid buckets of the size of the radius.
+    """
+
+    def __init__(self, lat, lon, radius):
+        import numpy as np
+
+        self.radius = radius
+        self.x, self.y = to_meters(lat, lon)
+
+        valid = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        self.n_valid = valid.shape[0]
+        if self.n_valid == 0:
+            return
+
+        cx = np.floor(self.x[valid] / radius).astype(np.int64)
+        cy = np.floor(self.y[valid] / radius).astype(np.int64)
+        self.cx0, self.cy0 = cx.min(), cy.min()
+        self.ncx, self.ncy = cx.max() - self.cx0 + 1, cy.max() - self.cy0 + 1
+
+        # Points sorted by the cell they fall in.
+        keys = (cx - self.cx0) * self.ncy + (cy - self.cy0)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.points = keys[order], valid[order]
+
+    def pairs(self, lat, lon):
+        """
+        Find all (position, point) pairs within the radius. Returns the index of the position, the index of the
+        point and the distance in meters for every pair.
+        """
+        import numpy as np
+
+        from preprocessing.boundaries import expand_ranges
+
+        x, y = to_meters(lat, lon)
+        empty = np.empty(0, dtype=np.int64)
+        if self.n_valid == 0:
+            return empty, empty, np.empty(0)
+
+        with np.errstate(invalid="ignore"):
+            cx = np.floor(x / self.radius) - self.cx0
+            cy = np.floor(y / self.radius) - self.cy0
+
+        positions, points = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                ncx, ncy = cx + dx, cy + dy
+                inside = np.flatnonzero((ncx >= 0) & (ncx < self.ncx) & (ncy >= 0) & (ncy < self.ncy))
+                keys = (ncx[inside] * self.ncy + ncy[inside]).astype(np.int64)
+                lo = np.searchsorted(self.keys, keys, side="left")
+                hi = np.searchsorted(self.keys, keys, side="right")
+                pos, k = expand_ranges(hi - lo)
+                positions.append(inside[pos])
+                points.append(self.points[lo[pos] + k])
+
+        positions, points = np.concatenate(positions), np.concatenate(points)
+        dist = np.hypot(x[positions] - self.x[points], y[positions] - self.y[points])
+        near = dist <= self.radius
+
+        return positions[near], points[near], dist[near]
+
+
+def load_station_trips(files, chunksize=500000, months=None):
+    """
+    Read the start and end times and starting stations of all CitiBike trips, or of the trips starting in the months
+    FIRST to LAST (YYYY-MM) in months. Returns the table of stations (station_id, latitude and longitude of its first
+    trip, number of rides) and a dict of arrays with the station (row in the table, -1 for trips without a station),
+    start and end time (seconds) of every trip.
+
+    Trips are deduplicated by ride id across all files like the rental rollups (see dedup.py), so overlapping or
+    re-downloaded trip files count every trip once.
+    """
+    import numpy as np
+    import pandas as pd
+
+    from preprocessing.citibikeIngest import iter_citibike_chunks
+    from preprocessing.dedup import KeySet, drop_duplicate_trips
+
+    codes = {}
+    station_ids, station_lat, station_lng = [], [], []
+    trip_station, trip_start, trip_end = [], [], []
+
+    seen = KeySet()
+    for chunk in iter_citibike_chunks(files, chunksize=chunksize, usecols=EXPOSURE_TRIP_COLUMNS):
+        chunk, _ = drop_duplicate_trips(chunk, seen)
+        start = pd.to_datetime(chunk["started_at"]).to_numpy().astype("datetime64[s]").astype(np.int64)
+        end = pd.to_datetime(chunk["ended_at"]).to_numpy().astype("datetime64[s]").astype(np.int64)
+        keep = (start != np.iinfo(np.int64).min) & (end != np.iinfo(np.int64).min)
+        if months is not None:
+            month = start.astype("datetime64[s]").astype("datetime64[M]")
+            keep &= (month >= np.datetime64(months[0], "M")) & (month <= np.datetime64(months[1], "M"))
+        chunk, start, end = chunk[keep], start[keep], end[keep]
+
+        # Map the station ids of the chunk onto the rows of the station table, adding the new ones.
+        chunk_codes, uniques = pd.factorize(chunk["start_station_id"].astype(object))
+        first = pd.Series(np.arange(chunk_codes.shape[0])).groupby(chunk_codes).first()
+        lookup = np.empty(uniques.shape[0], dtype=np.int64)
+        for i, station_id in enumerate(uniques):
+            if station_id not in codes:
+                codes[station_id] = len(station_ids)
+                station_ids.append(str(station_id))
+                row = first[i]
+                station_lat.append(chunk["start_lat"].iat[row])
+                station_lng.append(chunk["start_lng"].iat[row])
+            lookup[i] = codes[station_id]
+
+        trip_station.append(np.where(chunk_codes >= 0, lookup[chunk_codes] if lookup.shape[0] else -1, -1))
+        trip_start.append(start)
+        trip_end.append(end)
+
+    trips = {
+        "station": np.concatenate(trip_station) if trip_station else np.empty(0, dtype=np.int64),
+        "start": np.concatenate(trip_start) if trip_start else np.empty(0, dtype=np.int64),
+        "end": np.concatenate(trip_end) if trip_end else np.empty(0, dtype=np.int64),
+    }
+
+    stations = pd.DataFrame({"station_id": pd.Series(station_ids, dtype=str),
+                             "latitude": np.asarray(station_lat, dtype=np.float64),
+                             "longitude": np.asarray(station_lng, dtype=np.float64)})
+    stations["rides"] = np.bincount(trips["station"][trips["station"] >= 0], minlength=stations.shape[0])
+
+    return stations, trips
+
+
+def station_exposure(accidents, stations, trips, radius=250, window=3600):
+    """
+    Join every bike accident to the stations within radius meters and to the trips active within window seconds
+    of the crash. Only accidents within the period covered by the trips are joined.
+
+    Returns a table of the joined accidents (number of nearby stations, rides starting at them within the window and
+    trips active anywhere within the window) and the table of stations extended with the number of nearby accidents
+    and the accidents per 100k rides.
+    """
+    import numpy as np
+
+    crash = accidents["datetime"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    lat = accidents["latitude"].to_numpy(dtype=np.float64)
+    lon = accidents["longitude"].to_numpy(dtype=np.float64)
+
+    if trips["start"].shape[0]:
+        first, last = trips["start"].min(), trips["end"].max()
+    else:
+        first, last = 0, -1
+    period = np.flatnonzero((crash >= first - window) & (crash <= last + window))
+    crash, lat, lon = crash[period], lat[period], lon[period]
+
+    # Stations within the radius of every accident.
+    index = RadiusIndex(stations["latitude"].to_numpy(), stations["longitude"].to_numpy(), radius)
+    pair_accident, pair_station, _ = index.pairs(lat, lon)
+
+    # Rides starting at the station of every pair within the window, by binary search over the trips sorted by
+    # station and start time.
+    with_station = trips["station"] >= 0
+    station, start = trips["station"][with_station], trips["start"][with_station]
+    t0 = min(start.min() if start.shape[0] else 0, crash.min() - window if crash.shape[0] else 0)
+    t1 = max(start.max() if start.shape[0] else 0, crash.max() + window if crash.shape[0] else 0)
+    span = t1 - t0 + 1
+    ride_keys = np.sort(station * span + (start - t0))
+    pair_keys = pair_station * span + (crash[pair_accident] - t0)
+    pair_rides = (np.searchsorted(ride_keys, pair_keys + window, side="right") -
+                  np.searchsorted(ride_keys, pair_keys - window, side="left"))
+
+    # Trips active anywhere within the window: started before its end and not ended before its start.
+    active = (np.searchsorted(np.sort(trips["start"]), crash + window, side="right") -
+              np.searchsorted(np.sort(trips["end"]), crash - window, side="left"))
+
+    joined = accidents.iloc[period][["datetime", "collision id", "borough"]].reset_index(drop=True)
+    joined["nearby_stations"] = np.bincount(pair_accident, minlength=period.shape[0])
+    joined["nearby_rides"] = np.bincount(pair_accident, weights=pair_rides, minlength=period.shape[0]).astype(np.int64)
+    joined["active_trips"] = active
+
+    exposure = stations.copy()
+    exposure["accidents"] = np.bincount(pair_station, minlength=stations.shape[0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exposure["accidents_per_100k_rides"] = np.where(exposure["rides"] > 0,
+                                                        1e5 * exposure["accidents"] / exposure["rides"], np.nan)
+
+    return joined, exposure
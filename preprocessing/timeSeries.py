@@ -0,0 +1,84 @@
+"""
+Time series of the CitiBike rentals and the bike accidents per borough, hourly or daily, with rolling rates.
+
+The series are built from the hourly rollups (see rollups.py), so the trips and accidents are only binned once per
+source file: adding a month of trips adds the partials of its file and leaves the buckets of earlier months as they
+are. Series are bucketed and rolled per borough on a complete time grid with vectorized pandas operations.
+"""
+
+
+# Time buckets of the series, as pandas frequencies.
+FREQUENCIES = {"hour": "h", "day": "D"}
+
+# Columns of the rolling sums and rates.
+SERIES_VALUES = ["rentals", "accidents", "cyclists_injured", "cyclists_killed"]
+
+
+def bucket_series(hourly, freq="D"):
+    """
+    Sum hourly rollups (indexed by borough and hour) into buckets of the frequency freq. Returns a wide DataFrame per
+    value column, indexed by the start of the bucket, with one column per borough.
+    """
+    hourly = hourly.reset_index()
+    if hourly.shape[0] == 0:
+        return {}
+
+    bucket = hourly["hour"].dt.floor(freq).rename("time")
+    borough = hourly["borough"].astype(str)
+    return {col: hourly[col].groupby([bucket, borough]).sum().unstack("borough")
+            for col in SERIES_VALUES if col in hourly.columns}
+
+
+def exposure_series(rentals, accidents, freq="D", window=7):
+    """
+    Join the hourly rental and accident rollups into a series per borough and bucket of the frequency freq, over the
+    period of the rentals. Besides the counts of every bucket, the rolling sums over the last window buckets and the
+    accidents, injuries and deaths per 100k rentals within the window are computed.
+
+    Returns a DataFrame with the columns borough, time, the counts, their rolling sums (rolling_*) and the rates.
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = ["borough", "time"] + SERIES_VALUES + ["rolling_" + col for col in SERIES_VALUES]
+    rates = ["accidents_per_100k_rentals", "injuries_per_100k_rentals", "deaths_per_100k_rentals"]
+
+    series = bucket_series(rentals, freq)
+    if not series:
+        return pd.DataFrame(columns=columns + rates)
+    series.update({col: wide for col, wide in bucket_series(accidents, freq).items() if col != "rentals"})
+
+    # All value tables are aligned on a complete time grid over the period of the rentals and on all boroughs.
+    grid = pd.date_range(series["rentals"].index.min(), series["rentals"].index.max(), freq=freq, name="time")
+    boroughs = pd.Index(sorted(set().union(*(wide.columns for wide in series.values()))), name="borough")
+
+    frame = {}
+    for col in SERIES_VALUES:
+        wide = series.get(col, pd.DataFrame()).reindex(index=grid, columns=boroughs).fillna(0).astype("int64")
+        frame[col] = wide.stack()
+        frame["rolling_" + col] = wide.rolling(window, min_periods=1).sum().astype("int64").stack()
+    df = pd.DataFrame(frame).reset_index()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rolling_rentals = df["rolling_rentals"].where(df["rolling_rentals"] > 0)
+        df["accidents_per_100k_rentals"] = 1e5 * df["rolling_accidents"] / rolling_rentals
+        df["injuries_per_100k_rentals"] = 1e5 * df["rolling_cyclists_injured"] / rolling_rentals
+        df["deaths_per_100k_rentals"] = 1e5 * df["rolling_cyclists_killed"] / rolling_rentals
+
+    return df.sort_values(["borough", "time"], ignore_index=True)[columns + rates]
+
+
+def query_exposure_series(rollup_dir, freq="D", window=7, months=None, sources=None):
+    """
+    Build the exposure series from the hourly rollups in rollup_dir, for the rentals of the trip files in sources (all
+    by default) and the months FIRST to LAST (YYYY-MM) in months.
+    """
+    from preprocessing.rollups import query_rollups, HOURLY_KEYS
+
+    rentals = query_rollups(rollup_dir, "rentals_hourly", HOURLY_KEYS, months=months, sources=sources)
+    if rentals.shape[0]:
+        hours = rentals.index.get_level_values("hour")
+        months = (hours.min().strftime("%Y-%m"), hours.max().strftime("%Y-%m"))
+    accidents = query_rollups(rollup_dir, "accidents_hourly", HOURLY_KEYS, months=months)
+
+    return exposure_series(rentals, accidents, freq=FREQUENCIES.get(freq, freq), window=window)
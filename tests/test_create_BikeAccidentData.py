@@ -0,0 +1,155 @@
+"""
+Tests of the concurrent collection of the bike accidents in date partitions, against a local stand-in for the SoQL
+API of Socrata that fails some of the requests. Run from the repository folder with: python -m pytest tests
+"""
+
+import io
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import contextlib
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+
+from create_BikeAccidentData import collect_bike_accidents_partitioned, SoqlClient, FileClient
+from preprocessing.frameCache import read_frame
+
+
+def make_records(n_records):
+    """
+    Bike accidents in the format returned by Socrata, spread over the years 2019 to 2021.
+    """
+    dates = pd.date_range("2019-01-01", "2021-12-31", periods=n_records)
+    return [{"crash_date": date.strftime("%Y-%m-%dT00:00:00.000"), "crash_time": "12:00",
+             "borough": ["BROOKLYN", "MANHATTAN", "QUEENS"][i % 3], "collision_id": str(1000 + 7 * i),
+             "number_of_cyclist_injured": str(i % 2), "number_of_cyclist_killed": "0", "vehicle_type_code1": "Bike"}
+            for i, date in enumerate(dates)]
+
+
+class FlakySoqlServer:
+    """
+    Local SoQL server answering from a FileClient, failing every third request with HTTP 503 and every fifth with
+    HTTP 429.
+    """
+
+    def __init__(self, filepath):
+        client = FileClient(filepath)
+        self.calls = 0
+        self.failures = 0
+        lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    server.calls += 1
+                    status = 503 if server.calls % 3 == 0 else 429 if server.calls % 5 == 0 else 200
+                    server.failures += status != 200
+                if status != 200:
+                    self.send_response(status)
+                    self.end_headers()
+                    return
+
+                params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+                records = client.get("h9gi-nx95", where=params.get("$where"), limit=int(params["$limit"]))
+                body = json.dumps(records).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{:}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class TestCollectPartitioned(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = make_records(600)
+        fixture = os.path.join(self.tmp_dir, "accidents.json")
+        with open(fixture, "w") as f:
+            json.dump(self.records, f)
+
+        self.server = FlakySoqlServer(fixture)
+        self.output_dir = os.path.join(self.tmp_dir, "partitions")
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def collect(self, since="2019-01-01", until="2021-12-31"):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            paths = collect_bike_accidents_partitioned(self.output_dir, since=since, until=until,
+                                                       workers=3, page_size=40, retries=8, backoff=0.01,
+                                                       client=SoqlClient(self.server.url, timeout=10))
+        return paths, output.getvalue()
+
+    def test_collects_all_partitions_despite_failures(self):
+        paths, output = self.collect()
+
+        self.assertEqual([os.path.basename(os.path.splitext(path)[0]) for path in paths],
+                         ["2019-01-01", "2020-01-01", "2021-01-01"])
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+
+        df = pd.concat([read_frame(path) for path in paths], ignore_index=True)
+        self.assertEqual(df.shape[0], len(self.records))
+        self.assertEqual(df["collision id"].nunique(), len(self.records))
+        self.assertEqual(sorted(df["collision id"].astype("int64")),
+                         sorted(int(record["collision_id"]) for record in self.records))
+
+        # Every year spans several pages, so the failed requests were retried until the pages came through.
+        self.assertGreater(self.server.failures, 0)
+        self.assertEqual(output.count("Request failed"), self.server.failures)
+        self.assertIn("HTTP Error 503", output)
+        self.assertIn("HTTP Error 429", output)
+
+    def test_second_run_skips_completed_partitions(self):
+        paths, _ = self.collect()
+        mtimes = [os.stat(path).st_mtime_ns for path in paths]
+        calls = self.server.calls
+
+        paths_again, output = self.collect()
+
+        self.assertEqual(paths_again, paths)
+        self.assertEqual(self.server.calls, calls)
+        self.assertIn("Collecting 0 of 3 partitions", output)
+        self.assertEqual([os.stat(path).st_mtime_ns for path in paths], mtimes)
+
+    def test_first_partition_starts_at_since(self):
+        paths, _ = self.collect(since="2020-06-15", until="2021-12-31")
+
+        self.assertEqual([os.path.basename(os.path.splitext(path)[0]) for path in paths],
+                         ["2020-01-01", "2021-01-01"])
+        df = pd.concat([read_frame(path) for path in paths], ignore_index=True)
+        expected = [record for record in self.records if record["crash_date"][:10] >= "2020-06-15"]
+        self.assertEqual(df.shape[0], len(expected))
+        self.assertGreaterEqual(pd.to_datetime(df["crash date"]).min(), pd.Timestamp("2020-06-15"))
+
+        # An earlier since collects the first partition again, over all of its dates.
+        _, output = self.collect(since="2020-01-01", until="2021-12-31")
+        self.assertIn("Collecting 1 of 2 partitions", output)
+        df = read_frame(paths[0])
+        self.assertEqual(df.shape[0], sum(record["crash_date"].startswith("2020") for record in self.records))
+
+
+if __name__ == "__main__":
+    unittest.main()